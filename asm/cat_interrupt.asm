@@ -0,0 +1,33 @@
+.section devices
+dev0:
+        byte 0x83
+        addr on_input
+        byte 0xFF
+        addr buffer_0
+dev1:
+        byte 0x01
+        addr null
+        byte 0xFF
+        addr buffer_0
+
+.section data
+buffer_0:
+        res 0xFF
+
+.section text
+start:
+    ei
+    unset dev0
+idle:
+    jmp idle
+
+; Input arrived: print it and request the next line
+on_input:
+    set dev1
+    unset dev0
+    check dev0
+    jz end
+    iret
+
+end:
+    halt
@@ -0,0 +1,137 @@
+import argparse
+import base64
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from src.emulator.components.sink import FileSink
+from src.emulator.components.source import open_source, Source
+from src.emulator.emulator import Emulator
+from src.emulator.trace import TraceLevel
+from src.translator.translator import translate
+
+
+# Job of a manifest line:
+#   id                  name of the job directory, the line number by default
+#   program, image      operation codes or image path, or their bytes in
+#                       base64
+#   assembly            source text translated before the run
+#   input, input_path   input entries or a file read line by line
+#   engine, memory_model, max_ticks, max_instructions, max_wall_time,
+#   max_stack_depth
+#   trace               trace level, 'off' by default
+def job_program(job):
+    if 'assembly' in job:
+        return translate(job['assembly'])
+    if 'image' in job:
+        return base64.b64decode(job['image'])
+    return job['program']
+
+
+# Runs a job with its devices writing to sink, the result is ready for JSON
+def emulate_job(job, sink, trace_path=None, cancel=None):
+    result = {}
+    started = time.monotonic()
+    try:
+        if 'input_path' in job:
+            source = open_source(job['input_path'])
+        else:
+            source = Source(job.get('input', ()))
+        # Console devices and the control unit report on stdout
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull), source:
+            emulator = Emulator(job_program(job), source,
+                                job.get('engine', 'microcode'),
+                                job.get('memory_model', 'flat'), sink,
+                                max_ticks=job.get('max_ticks'),
+                                max_instructions=job.get('max_instructions'),
+                                cancel=cancel,
+                                max_wall_time=job.get('max_wall_time'),
+                                max_stack_depth=job.get('max_stack_depth'))
+            emulation = emulator.run(TraceLevel(job.get('trace', 'off')),
+                                     trace_path)
+        result.update(status=emulation.status, tick=emulation.tick,
+                      instruction=emulation.instruction)
+        if emulation.error is not None:
+            result.update(error=emulation.error, limit=emulation.limit,
+                          pc=emulation.pc)
+    except Exception as error:
+        result.update(status='error', error=str(error))
+    result['wall_time'] = round(time.monotonic() - started, 6)
+    return result
+
+
+# Transcript and trace go to the job directory
+def run_job(job, output_dir):
+    job_dir = os.path.join(output_dir, str(job['id']))
+    os.makedirs(job_dir, exist_ok=True)
+    with FileSink(os.path.join(job_dir, 'out.txt')) as sink:
+        result = emulate_job(job, sink, os.path.join(job_dir, 'sources.txt'))
+    return dict(id=job['id'], **result)
+
+
+# Pool workers take a single argument
+def run_task(task):
+    return run_job(*task)
+
+
+# Ids name the job directories, so they must be unique and stay inside
+# the output directory
+def check_job_ids(jobs):
+    names = set()
+    for job in jobs:
+        name = str(job['id'])
+        if (not name or name == '.' or '..' in name or os.path.isabs(name)
+                or '/' in name or os.sep in name
+                or os.altsep is not None and os.altsep in name):
+            raise ValueError(f'Invalid job id: {job["id"]!r}')
+        if name in names:
+            raise ValueError(f'Duplicate job id: {job["id"]!r}')
+        names.add(name)
+
+
+# Runs the jobs on a process pool, results are yielded as jobs finish
+def run_batch(jobs, output_dir, processes=None):
+    tasks = [(dict(job, id=job.get('id', index)), output_dir)
+             for index, job in enumerate(jobs)]
+    check_job_ids([job for job, _ in tasks])
+    with multiprocessing.Pool(processes) as pool:
+        yield from pool.imap_unordered(run_task, tasks)
+
+
+def read_manifest(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def main(manifest, output_dir='batch', results_path=None, processes=None):
+    jobs = read_manifest(manifest)
+    output = sys.stdout
+    if results_path is not None:
+        output = open(results_path, 'w', encoding='utf-8')
+    try:
+        for result in run_batch(jobs, output_dir, processes):
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CSA Lab 3 batch runner")
+    parser.add_argument("-m", "--manifest", required=True, type=str,
+                        help="File with a JSON job per line")
+    parser.add_argument("-d", "--output-dir", default='batch', type=str,
+                        help="Directory with a subdirectory of outputs per "
+                             "job")
+    parser.add_argument("-r", "--results", default=None, type=str,
+                        help="File with a JSON result per line, stdout by "
+                             "default")
+    parser.add_argument("-j", "--processes", default=None, type=int,
+                        help="Worker processes, all cores by default")
+    args = parser.parse_args()
+    main(args.manifest, args.output_dir, args.results, args.processes)
@@ -0,0 +1,402 @@
+from src.emulator.components.commutator import commutator_flags_mask
+from src.emulator.components.memory import PAGE_BITS
+from src.emulator.control_unit import ControlUnit
+from src.emulator.data_path import decode_micro_operation
+from src.emulator.functional_unit import FunctionalControlUnit, \
+    handler_table, instruction_handlers, fetch_ticks, arbitrary_stores, \
+    stack_effects, WORD_MASK, ADDR_MASK
+from src.emulator.mc_mnemonic_parser import parse_mnemonic
+
+MAX_BLOCK_LENGTH = 64
+
+
+# ALU kernel and the SR bits it updates for a single microcode step
+def _flag_step(mnemonic):
+    micro_operation = decode_micro_operation(parse_mnemonic(mnemonic))
+    return (micro_operation.alu,
+            commutator_flags_mask(micro_operation.commutator_code))
+
+
+flag_steps = {
+    'add': _flag_step('BR + DR -> DR {NZVC}'),
+    'sub': _flag_step('BR + ~DR+1 -> DR {NZVC}'),
+    'mul': _flag_step('BR * DR -> DR {NZVC}'),
+    'div': _flag_step('BR / DR -> DR {NZVC}'),
+    'and': _flag_step('BR & DR -> DR {NZ}'),
+    'nor': _flag_step('~BR & ~DR -> DR'),
+    'not': _flag_step('~DR -> DR {NZ}'),
+    'neg': _flag_step('~DR+1 -> DR {NZ}'),
+    'cmp': _flag_step('BR + ~DR+1 -> BR {NZVC}'),
+}
+
+# Shift steps have no flags, their commutator result is inlined
+shift_expressions = {
+    'shl': '(tos << 1) & 0xFFFFFFFF',
+    'rol': '(tos << 1) & 0xFFFFFFFF',
+    'shr': 'tos >> 1',
+    'ror': '((tos >> 1) | (tos << 31)) & 0xFFFFFFFF',
+}
+
+# Taken condition of conditional jumps on the local SR copy
+jump_conditions = {
+    'jz': 'sr & 0x4 != 0',
+    'je': 'sr & 0x4 != 0',
+    'jnz': 'sr & 0x4 == 0',
+    'jg': 'sr & 0x8 == 0',
+    'jge': 'sr & 0xC != 0x8',
+    'jl': 'sr & 0x8 != 0',
+    'jle': 'sr & 0xC != 0',
+}
+
+# Instructions ending a block: control flow, SR updates that may stop the
+# processor or let a pending interrupt in and stores to arbitrary addresses
+# (devices and code)
+terminators = {'jmp', 'jz', 'je', 'jnz', 'jg', 'jge', 'jl', 'jle', 'call',
+               'ret', 'iret', 'halt', 'popf', 'ei', 'st', 'set', 'unset'}
+
+handler_names = {handler: name for name, handler
+                 in instruction_handlers.items()}
+
+
+def instruction_name(word):
+    entry = handler_table[word >> 24]
+    if entry is None:
+        return None
+    name = handler_names[entry[0]]
+    return 'jz' if name == 'je' else name
+
+
+# Generates the source of a single basic block. SP and SR are kept in
+# locals, TOS and NOS are cached in locals and written through to memory.
+class BlockGenerator:
+    def __init__(self, start, words):
+        self.start = start
+        self.words = words
+        self.lines = []
+        self.tos_cached = False
+        self.nos_cached = False
+
+    def emit(self, line):
+        self.lines.append('    ' + line)
+
+    def load_tos(self):
+        if not self.tos_cached:
+            self.emit('tos = m[sp & 0xFFFFFF]')
+            self.tos_cached = True
+
+    def load_nos(self):
+        if not self.nos_cached:
+            self.emit('nos = m[(sp + 1) & 0xFFFFFF]')
+            self.nos_cached = True
+
+    def push_cached(self, value):
+        self.emit('sp = (sp - 1) & 0xFFFFFFFF')
+        self.emit(f'm[sp & 0xFFFFFF] = {value}')
+        if self.tos_cached:
+            self.emit('nos = tos')
+        self.nos_cached = self.tos_cached
+        self.emit(f'tos = {value}')
+        self.tos_cached = True
+
+    def update_flags(self, name, lhs, rhs):
+        alu, mask = flag_steps[name]
+        self.emit(f'res, flags = {name}_alu({lhs}, {rhs})')
+        if mask != 0:
+            self.emit(f'sr = (sr & ~{mask:#x}) | (flags & {mask:#x})')
+
+    # Returns the expressions of AR, DR and BR after the instruction,
+    # None keeps the value stored in the registry
+    def gen_instruction(self, name, addr, word, last):
+        value = word & ADDR_MASK
+        fetched = (str(addr), str(word), str(addr))
+
+        if name == 'nop':
+            return fetched
+        if name == 'pop':
+            self.emit('sp = (sp + 1) & 0xFFFFFFFF')
+            if self.nos_cached:
+                self.emit('tos = nos')
+            self.tos_cached = self.nos_cached
+            self.nos_cached = False
+            return fetched
+        if name == 'push':
+            self.push_cached(value)
+            return 'sp', str(value), str(addr)
+        if name == 'pushf':
+            self.push_cached('sr')
+            return 'sp', 'tos', str(addr)
+        if name == 'popf':
+            self.load_tos()
+            self.emit('ar = sp')
+            self.emit('sr = tos')
+            self.emit('sp = (sp + 1) & 0xFFFFFFFF')
+            return 'ar', 'sr', str(addr)
+        if name in ('inc', 'dec'):
+            self.load_tos()
+            delta = '+ 1' if name == 'inc' else '- 1'
+            self.emit(f'tos = (tos {delta}) & 0xFFFFFFFF')
+            self.emit('m[sp & 0xFFFFFF] = tos')
+            return 'sp', 'tos', str(addr)
+        if name == 'swap':
+            self.load_tos()
+            self.load_nos()
+            self.emit('m[sp & 0xFFFFFF] = nos')
+            self.emit('m[(sp + 1) & 0xFFFFFF] = tos')
+            self.emit('tos, nos = nos, tos')
+            return '(sp + 1) & 0xFFFFFFFF', 'nos', 'nos'
+        if name == 'dup':
+            self.load_tos()
+            self.emit('sp = (sp - 1) & 0xFFFFFFFF')
+            self.emit('m[sp & 0xFFFFFF] = tos')
+            self.emit('nos = tos')
+            self.nos_cached = True
+            return 'sp', 'tos', str(addr)
+        if name == 'ret':
+            self.load_tos()
+            self.emit('ar = sp')
+            self.emit('pc = tos')
+            self.emit('sp = (sp + 1) & 0xFFFFFFFF')
+            return 'ar', 'pc', str(addr)
+        if name in ('add', 'sub', 'mul', 'div', 'and', 'or'):
+            self.load_tos()
+            self.load_nos()
+            if name == 'or':
+                self.update_flags('nor', 'tos', 'nos')
+                self.update_flags('not', 'res', '0')
+            else:
+                self.update_flags(name, 'tos', 'nos')
+            if last:
+                self.emit('br = tos')
+            self.emit('sp = (sp + 1) & 0xFFFFFFFF')
+            self.emit('m[sp & 0xFFFFFF] = res')
+            self.emit('tos = res')
+            self.nos_cached = False
+            return 'sp', 'tos', 'br'
+        if name in ('not', 'neg'):
+            self.load_tos()
+            self.update_flags(name, 'tos', '0')
+            self.emit('tos = res')
+            self.emit('m[sp & 0xFFFFFF] = tos')
+            return 'sp', 'tos', str(addr)
+        if name in shift_expressions:
+            self.load_tos()
+            self.emit(f'tos = {shift_expressions[name]}')
+            self.emit('m[sp & 0xFFFFFF] = tos')
+            return 'sp', 'tos', str(addr)
+        if name == 'cmp':
+            self.load_tos()
+            self.load_nos()
+            self.update_flags('cmp', 'tos', 'nos')
+            return '(sp + 1) & 0xFFFFFFFF', 'nos', 'res'
+        if name == 'ld':
+            self.load_tos()
+            self.emit('res = m[tos & 0xFFFFFF]')
+            self.emit('sp = (sp - 1) & 0xFFFFFFFF')
+            self.emit('m[sp & 0xFFFFFF] = res')
+            self.emit('nos = tos')
+            self.emit('tos = res')
+            self.nos_cached = True
+            return 'sp', 'tos', str(addr)
+        if name == 'halt':
+            self.emit('sr &= 0x7FFF')
+            return fetched
+        if name == 'ei':
+            self.emit('sr |= 0x4000')
+            return fetched
+        if name == 'di':
+            self.emit('sr &= 0xBFFF')
+            return fetched
+        if name == 'jmp':
+            self.emit(f'pc = {value}')
+            return fetched
+        if name in jump_conditions:
+            taken = fetch_ticks + handler_table[word >> 24][1]
+            not_taken = fetch_ticks + handler_table[word >> 24][2]
+            self.emit(f'if {jump_conditions[name]}:')
+            self.emit(f'    pc = {value}')
+            self.emit(f'    ticks += {taken}')
+            self.emit('else:')
+            self.emit(f'    ticks += {not_taken}')
+            return fetched
+        if name == 'call':
+            self.push_cached((addr + 1) & WORD_MASK)
+            self.emit(f'pc = {value}')
+            return 'sp', str((addr + 1) & WORD_MASK), str(addr)
+
+        # Everything else runs through its functional handler
+        self.emit('r.SP = sp')
+        self.emit('r.SR = sr')
+        self.emit(f'r.PC = {(addr + 1) & WORD_MASK}')
+        self.emit(f'r.CR = r.DR = {word}')
+        self.emit(f'r.AR = r.BR = {addr}')
+        self.emit(f'exec_{name}(r, m)')
+        self.emit('sp = r.SP')
+        self.emit('sr = r.SR')
+        if last:
+            self.emit('pc = r.PC')
+        if name in arbitrary_stores:
+            self.emit('written(r.AR & 0xFFFFFF)')
+        self.tos_cached = self.nos_cached = False
+        return None, None, None
+
+    def generate(self):
+        # Stack writes must not touch watched cells (translated code or
+        # devices), otherwise the block falls back to single instructions
+        offsets = []
+        sp = 0
+        for addr, word, name in self.words:
+            writes, delta = stack_effects.get(name, ((), 0))
+            offsets += [sp + offset for offset in writes]
+            sp += delta
+        if offsets:
+            low, high = min(offsets), max(offsets)
+            self.emit(f'if watched((r.SP + {low}) & 0xFFFFFF, '
+                      f'{high - low + 1}):')
+            self.emit('    return None')
+
+        self.emit('sp = r.SP')
+        self.emit('sr = r.SR')
+        last_addr, last_word, last_name = self.words[-1]
+        self.emit(f'pc = {(last_addr + 1) & WORD_MASK}')
+
+        ticks = 0
+        registers = None
+        for index, (addr, word, name) in enumerate(self.words):
+            registers = self.gen_instruction(name, addr, word,
+                                             index == len(self.words) - 1)
+            if name not in jump_conditions:
+                ticks += fetch_ticks + handler_table[word >> 24][1]
+
+        self.emit('r.SP = sp')
+        self.emit('r.SR = sr')
+        self.emit('r.PC = pc')
+        self.emit(f'r.CR = {last_word}')
+        for register, expression in zip(('AR', 'DR', 'BR'), registers):
+            if expression is not None:
+                self.emit(f'r.{register} = {expression}')
+        self.emit('return ticks')
+
+        header = [f'def block_{self.start:06x}(r, m):',
+                  f'    ticks = {ticks}']
+        return '\n'.join(header + self.lines) + '\n'
+
+
+# Translated blocks keyed by guest PC, invalidated on writes into their pages
+class TranslationCache:
+    def __init__(self, memory):
+        self.memory = memory
+        self.blocks = {}
+        self.block_ends = {}
+        self.page_blocks = {}
+        self.namespace = {
+            'watched': memory.watched,
+            'written': memory.written,
+        }
+        for name, handler in instruction_handlers.items():
+            self.namespace[f'exec_{name}'] = handler
+        for name, (alu, mask) in flag_steps.items():
+            self.namespace[f'{name}_alu'] = alu
+
+    def decode_block(self, start):
+        cells = self.memory.cells
+        words = []
+        addr = start
+        while len(words) < MAX_BLOCK_LENGTH and addr <= ADDR_MASK:
+            word = cells[addr]
+            name = instruction_name(word)
+            if name is None:
+                break
+            words.append((addr, word, name))
+            if name in terminators:
+                break
+            addr += 1
+        if not words:
+            raise ValueError(f'Invalid opcode: {cells[start] >> 24:02X}')
+        return words
+
+    def translate(self, start):
+        words = self.decode_block(start)
+        source = BlockGenerator(start, words).generate()
+        exec(source, self.namespace)
+        # Most ticks the block may take, with every branch on its longer path
+        ticks = sum(fetch_ticks + max(handler_table[word >> 24][1:3])
+                    for addr, word, name in words)
+        block = (self.namespace.pop(f'block_{start:06x}'), len(words), ticks)
+
+        self.blocks[start] = block
+        end = words[-1][0]
+        self.block_ends[start] = end
+        for page in range(start >> PAGE_BITS, (end >> PAGE_BITS) + 1):
+            if page not in self.page_blocks:
+                self.page_blocks[page] = set()
+                self.memory.watch(page << PAGE_BITS, 1 << PAGE_BITS,
+                                  self.invalidate)
+            self.page_blocks[page].add(start)
+        return block
+
+    # Drops the blocks overlapping written cells
+    def invalidate(self, addr, count):
+        last = addr + count - 1
+        for page in range(addr >> PAGE_BITS, (last >> PAGE_BITS) + 1):
+            starts = self.page_blocks.get(page)
+            if starts is None:
+                continue
+            for start in [start for start in starts
+                          if start <= last and self.block_ends[start] >= addr]:
+                end = self.block_ends.pop(start)
+                self.blocks.pop(start)
+                for block_page in range(start >> PAGE_BITS,
+                                        (end >> PAGE_BITS) + 1):
+                    self.page_blocks[block_page].discard(start)
+                    if not self.page_blocks[block_page]:
+                        del self.page_blocks[block_page]
+                        self.memory.unwatch(block_page << PAGE_BITS,
+                                            1 << PAGE_BITS, self.invalidate)
+
+
+# Runs whole basic blocks compiled into Python functions, trace and devices
+# are handled once per block
+class BlockControlUnit(FunctionalControlUnit):
+    def __init__(self, registers, memory, data_path, io_devices):
+        super().__init__(registers, memory, data_path, io_devices)
+        self.translation_cache = TranslationCache(memory)
+
+    # Blocks are run one by one
+    run_until = ControlUnit.run_until
+
+    def step_instruction(self):
+        FunctionalControlUnit.process(self)
+
+    def process(self):
+        # Blocks keep PC within the address space, a PC with the high bits
+        # set (like a return address popped from a device cell) is stepped
+        if self.registers.PC > ADDR_MASK:
+            super().process()
+            return
+
+        pc = self.registers.PC
+        block = self.translation_cache.blocks.get(pc)
+        if block is None:
+            block = self.translation_cache.translate(pc)
+
+        function, length, max_ticks = block
+        # A block that may run past the next checkpoint is stepped, so the
+        # limits stop the run where the other engines do
+        if self.tick + max_ticks > self.end_tick:
+            super().process()
+            return
+
+        ticks = function(self.registers, self.memory.cells)
+        if ticks is None:
+            # Stack is close to translated code or devices, step a single
+            # instruction reporting its writes
+            super().process()
+            return
+
+        self.tick += ticks
+        self.instruction += length
+        self.handle_devices()
+        # Interrupts are taken between blocks
+        if (self.interrupt_controller.pending
+                and self.registers.SR & 0xC000 == 0xC000):
+            self.enter_interrupt()
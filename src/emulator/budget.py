@@ -0,0 +1,99 @@
+import math
+import time
+
+from src.emulator.microcode import microprogram_ticks, rom
+
+# Ticks between checks of the limits that do not map onto a tick
+CHECK_INTERVAL = 1 << 14
+# Every instruction takes at least its fetch
+MIN_STEP_TICKS = microprogram_ticks(rom['fetch'])
+# Most cells an instruction pushes (set, unset and check), an interrupt
+# entry pushes fewer over more ticks
+MAX_STEP_PUSH = 3
+
+
+# Keeps where the machine stopped: PC and the tick and instruction counters
+class LimitExceeded(Exception):
+    def __init__(self, limit, value, pc=0, tick=0, instruction=0):
+        super().__init__(f'{self.reason(limit, value)} at PC {pc:06X} '
+                         f'(tick {tick}, instruction {instruction})')
+        self.limit = limit
+        self.value = value
+        self.pc = pc
+        self.tick = tick
+        self.instruction = instruction
+
+    def reason(self, limit, value):
+        return f'Error: {limit} limit of {value} exceeded'
+
+
+class Cancelled(LimitExceeded):
+    def reason(self, limit, value):
+        return 'Error: emulation cancelled'
+
+
+# Execution limits of a run, cancel is anything with is_set() like an
+# event. Like the pacer it returns the tick of its next check, so the
+# emulation loop pays for a single comparison per step. The tick limit is
+# exact, the instruction and stack depth limits are checked no later than
+# the remaining instructions or stack cells can take at MIN_STEP_TICKS per
+# instruction, the others are checked every CHECK_INTERVAL ticks. Stack
+# depth is the number of cells pushed below SP at the start of the run
+class Budget:
+    def __init__(self, max_ticks=None, max_instructions=None, cancel=None,
+                 max_wall_time=None, max_stack_depth=None):
+        self.max_ticks = max_ticks
+        self.max_instructions = max_instructions
+        self.cancel = cancel
+        self.max_wall_time = max_wall_time
+        self.max_stack_depth = max_stack_depth
+        self.periodic = any(limit is not None for limit in (
+            max_instructions, cancel, max_wall_time, max_stack_depth))
+        self.deadline = math.inf
+        self.stack_floor = -math.inf
+
+    def start(self, control_unit):
+        if self.max_wall_time is not None:
+            self.deadline = time.monotonic() + self.max_wall_time
+        if self.max_stack_depth is not None:
+            self.stack_floor = (control_unit.registers.SP
+                                - self.max_stack_depth)
+        return self.check(control_unit)
+
+    def exceeded(self, control_unit, limit, value, error=LimitExceeded):
+        return error(limit, value, control_unit.registers.PC & 0xFFFFFF,
+                     control_unit.tick, control_unit.instruction)
+
+    # Raises LimitExceeded once a limit is reached
+    def check(self, control_unit):
+        if (self.max_ticks is not None
+                and control_unit.tick >= self.max_ticks):
+            raise self.exceeded(control_unit, 'tick', self.max_ticks)
+        if not self.periodic:
+            return self.max_ticks if self.max_ticks is not None else math.inf
+
+        if (self.max_instructions is not None
+                and control_unit.instruction >= self.max_instructions):
+            raise self.exceeded(control_unit, 'instruction',
+                                self.max_instructions)
+        if control_unit.registers.SP < self.stack_floor:
+            raise self.exceeded(control_unit, 'stack depth',
+                                self.max_stack_depth)
+        if time.monotonic() >= self.deadline:
+            raise self.exceeded(control_unit, 'wall time',
+                                self.max_wall_time)
+        if self.cancel is not None and self.cancel.is_set():
+            raise self.exceeded(control_unit, 'cancel', None, Cancelled)
+
+        next_tick = control_unit.tick + CHECK_INTERVAL
+        if self.max_ticks is not None:
+            next_tick = min(next_tick, self.max_ticks)
+        if self.max_instructions is not None:
+            next_tick = min(next_tick, control_unit.tick + MIN_STEP_TICKS * (
+                self.max_instructions - control_unit.instruction))
+        if self.max_stack_depth is not None:
+            steps = max(1, (control_unit.registers.SP - self.stack_floor)
+                        // MAX_STEP_PUSH)
+            next_tick = min(next_tick,
+                            control_unit.tick + MIN_STEP_TICKS * steps)
+        return next_tick
@@ -18,45 +18,63 @@ def alu_code(operation, op1, op2):
     return operation.value << 4 | op1 << 2 | op2
 
 
-def process_alu_code(lhs, rhs, code):
-    res = 0
+def _gen_operand_source(name, operation):
+    lines = []
+    if operation & OperandOperation.NOT.value != 0:
+        lines.append(f'    {name} = ~{name}')
+    if operation & OperandOperation.INC.value != 0:
+        lines.append(f'    {name} += 1')
+    return lines
+
 
+def gen_alu_kernel_source(code, flags=True):
     operation = (code >> 4) & 0b11
-    lhs_op = (code >> 2) & 0b11
-    rhs_op = code & 0b11
-
-    lhs_val = lhs
-    if lhs_op & OperandOperation.NOT.value != 0:
-        lhs_val = ~lhs
-    if lhs_op & OperandOperation.INC.value != 0:
-        lhs_val += 1
-
-    rhs_val = rhs
-    if rhs_op & OperandOperation.NOT.value != 0:
-        rhs_val = ~rhs
-    if rhs_op & OperandOperation.INC.value != 0:
-        rhs_val += 1
-
-    flags = 0
+    lines = [f'def alu_kernel_{code:02x}(lhs, rhs):']
+    lines += _gen_operand_source('lhs', (code >> 2) & 0b11)
+    lines += _gen_operand_source('rhs', code & 0b11)
+
     if operation == AluOperations.ADD.value:
-        res = lhs_val + rhs_val
-        if res > 0xFFFFFFFF:
-            flags |= 0x1  # Carry
-        if (lhs_val > 0 > res and rhs_val > 0) or (
-                lhs_val < 0 < res and rhs_val < 0):
-            flags |= 0x2  # Overflow
+        lines.append('    res = lhs + rhs')
     elif operation == AluOperations.AND.value:
-        res = lhs_val & rhs_val
+        lines.append('    res = lhs & rhs')
     elif operation == AluOperations.MUL.value:
-        res = lhs_val * rhs_val
-        if res > 0xFFFFFFFF:
-            flags |= 0x1  # Carry
+        lines.append('    res = lhs * rhs')
     elif operation == AluOperations.DIV.value:
-        res = lhs_val // rhs_val
+        lines.append('    res = lhs // rhs')
+
+    if not flags:
+        lines.append('    return res & 0xFFFFFFFF, 0')
+        return '\n'.join(lines) + '\n'
+
+    lines.append('    flags = 0')
+    if operation in (AluOperations.ADD.value, AluOperations.MUL.value):
+        lines.append('    if res > 0xFFFFFFFF:')
+        lines.append('        flags |= 0x1  # Carry')
+    if operation == AluOperations.ADD.value:
+        lines.append('    if (lhs > 0 > res and rhs > 0) or '
+                     '(lhs < 0 < res and rhs < 0):')
+        lines.append('        flags |= 0x2  # Overflow')
+    lines.append('    if res & 0x80000000 != 0:')
+    lines.append('        flags |= 0x8  # Negative')
+    lines.append('    if res == 0:')
+    lines.append('        flags |= 0x4  # Zero')
+    lines.append('    return res & 0xFFFFFFFF, flags')
+    return '\n'.join(lines) + '\n'
 
-    if res & 0x80000000 != 0:
-        flags |= 0x8  # Negative
-    if res == 0:
-        flags |= 0x4  # Zero
 
-    return res & 0xFFFFFFFF, flags
+# Dedicated function for every (code, flags) pair, generated on first use
+alu_kernels = {}
+
+
+def alu_kernel(code, flags=True):
+    kernel = alu_kernels.get((code, flags))
+    if kernel is None:
+        namespace = {}
+        exec(gen_alu_kernel_source(code, flags), namespace)
+        kernel = namespace[f'alu_kernel_{code:02x}']
+        alu_kernels[(code, flags)] = kernel
+    return kernel
+
+
+def process_alu_code(lhs, rhs, code):
+    return alu_kernel(code)(lhs, rhs)
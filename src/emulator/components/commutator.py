@@ -32,41 +32,72 @@ def commutator_code(flags):
     return res
 
 
-def process_commutator_code(data, opcode, flags, registers) -> int:
-    res = 0
+# NZVC bits of SR updated by the commutator
+def commutator_flags_mask(code):
+    flags_mask = 0
+    if code & CommutatorFlags.SET_NZ.value != 0:
+        flags_mask |= 0b1100
+    if code & CommutatorFlags.SET_V.value != 0:
+        flags_mask |= 0b0010
+    if code & CommutatorFlags.SET_C.value != 0:
+        flags_mask |= 0b0001
+    return flags_mask
+
+
+def gen_commutator_kernel_source(code):
+    lines = [f'def commutator_kernel_{code:03x}(data, flags, registers):']
 
-    if opcode & opcode & CommutatorFlags.LTOH.value != 0 \
-            and opcode & opcode & CommutatorFlags.LTOL.value != 0 \
-            and opcode & opcode & CommutatorFlags.HTOH.value != 0 \
-            and opcode & opcode & CommutatorFlags.HTOL.value:
-        res = data & 0x00FFFFFF
+    # ROL shares its bits with SHL and SHR, so the SHL check wins for it
+    if code & CommutatorFlags.SHL.value != 0:
+        lines.append('    res = data << 1')
+    elif code & CommutatorFlags.SHR.value != 0:
+        lines.append('    res = data >> 1')
+    elif code & CommutatorFlags.ROR.value != 0:
+        lines.append('    res = (data >> 1) | (data << 31)')
+    elif code & CommutatorFlags.CUTB.value == CommutatorFlags.CUTB.value:
+        lines.append('    res = data & 0x00FFFFFF')
     else:
         # Bit mutations
-        if opcode & CommutatorFlags.LTOH.value != 0:
-            res |= (data & 0x0000FFFF) << 16
-        if opcode & CommutatorFlags.LTOL.value != 0:
-            res |= (data & 0x0000FFFF)
-        if opcode & CommutatorFlags.HTOL.value != 0:
-            res |= (data & 0xFFFF0000) >> 16
-        if opcode & CommutatorFlags.HTOH.value != 0:
-            res |= (data & 0xFFFF0000)
-
-    # Bit shifts
-    if opcode & CommutatorFlags.SHL.value != 0:
-        res = data << 1
-    elif opcode & CommutatorFlags.SHR.value != 0:
-        res = data >> 1
-    elif opcode & CommutatorFlags.ROL.value != 0:
-        res = (data << 1) | (data >> 31)
-    elif opcode & CommutatorFlags.ROR.value != 0:
-        res = (data >> 1) | (data << 31)
+        terms = []
+        if code & CommutatorFlags.LTOH.value != 0:
+            terms.append('((data & 0x0000FFFF) << 16)')
+        if code & CommutatorFlags.LTOL.value != 0:
+            terms.append('(data & 0x0000FFFF)')
+        if code & CommutatorFlags.HTOL.value != 0:
+            terms.append('((data & 0xFFFF0000) >> 16)')
+        if code & CommutatorFlags.HTOH.value != 0:
+            terms.append('(data & 0xFFFF0000)')
+        if terms == ['(data & 0x0000FFFF)', '(data & 0xFFFF0000)']:
+            terms = ['data']
+        lines.append(f'    res = {" | ".join(terms) if terms else "0"}')
 
     # Flags
-    if opcode & CommutatorFlags.SET_NZ.value != 0:
-        registers.SR = (registers.SR & ~0b1100) | (flags & 0b1100)
-    if opcode & CommutatorFlags.SET_V.value != 0:
-        registers.SR = (registers.SR & ~0b0010) | (flags & 0b0010)
-    if opcode & CommutatorFlags.SET_C.value != 0:
-        registers.SR = (registers.SR & ~0b0001) | (flags & 0b0001)
-
-    return res & 0xFFFFFFFF
+    flags_mask = commutator_flags_mask(code)
+    if flags_mask != 0:
+        lines.append(f'    registers.SR = (registers.SR & ~{flags_mask:#06b}) '
+                     f'| (flags & {flags_mask:#06b})')
+
+    lines.append('    return res & 0xFFFFFFFF')
+    return '\n'.join(lines) + '\n'
+
+
+def commutator_sets_flags(code):
+    return commutator_flags_mask(code) != 0
+
+
+# Dedicated function for every commutator code, generated on first use
+commutator_kernels = {}
+
+
+def commutator_kernel(code):
+    kernel = commutator_kernels.get(code)
+    if kernel is None:
+        namespace = {}
+        exec(gen_commutator_kernel_source(code), namespace)
+        kernel = namespace[f'commutator_kernel_{code:03x}']
+        commutator_kernels[code] = kernel
+    return kernel
+
+
+def process_commutator_code(data, opcode, flags, registers) -> int:
+    return commutator_kernel(opcode)(data, flags, registers)
@@ -1,8 +1,37 @@
+from src.emulator.components.sink import Sink
+
+# Flag of the device vector cell enabling its interrupts
+INTERRUPT_FLAG = 0x02000000
+
+
 class IODevice:
-    def __init__(self, dev_id, registers, memory):
+    def __init__(self, dev_id, registers, memory, sink=None):
+        self.dev_id = dev_id
         self.init_vector_addr = dev_id * 2
         self.registers = registers
         self.memory = memory
+        # Transfers are logged to the sink, it stays open between them
+        self.sink = sink if sink is not None else Sink()
+        self.control_unit = None
+        self.index = None
+
+    # Connects the device to the processor clock and interrupt controller,
+    # index is its position in the processor device list
+    def attach(self, control_unit, index):
+        self.control_unit = control_unit
+        self.index = index
+
+    # Requests an interrupt if the device has them enabled
+    def raise_interrupt(self):
+        if (self.control_unit is not None
+                and self.memory.cells[self.init_vector_addr]
+                & INTERRUPT_FLAG):
+            self.control_unit.interrupt_controller.raise_interrupt(
+                self.dev_id)
+
+    # Status and buffer cells written by the processor wake the device
+    def watch(self, listener):
+        self.memory.watch(self.init_vector_addr, 2, listener)
 
     def get_buffer(self):
         buffer = self.memory.cells[self.init_vector_addr + 1]
@@ -13,22 +42,41 @@ class IODevice:
         status = self.memory.cells[self.init_vector_addr]
         return status & 0x80000000
 
+    # Every transfer of a device is counted as activity
     def set_ready(self):
         self.memory.cells[self.init_vector_addr] |= 0x80000000
+        if self.control_unit is not None:
+            self.control_unit.device_activity += 1
 
     def unset_ready(self):
         self.memory.cells[self.init_vector_addr] &= 0x7FFFFFFF
+        if self.control_unit is not None:
+            self.control_unit.device_activity += 1
 
     def process(self):
         pass
 
+    def flush(self):
+        self.sink.flush()
 
-# Writes data into a memory buffer
+
+# Writes data into a memory buffer. Input is any iterable pulled an entry at
+# a time when the ready bit is clear, an entry is either a string or
+# (tick, string), the latter is available from that tick on
 class InputDevice(IODevice):
-    def __init__(self, dev_id, registers, memory, input_data):
-        self.it = 0
-        self.input_data = input_data
-        super().__init__(dev_id, registers, memory)
+    def __init__(self, dev_id, registers, memory, input_data, sink=None):
+        self.input_data = iter(input_data)
+        self.entry = None
+        super().__init__(dev_id, registers, memory, sink)
+
+    # Next entry as (arrival, string), None when the input is exhausted
+    def peek(self):
+        if self.entry is None:
+            entry = next(self.input_data, None)
+            if entry is not None and not isinstance(entry, tuple):
+                entry = (0, entry)
+            self.entry = entry
+        return self.entry
 
     def process(self):
         # Data is not read by the processor yet
@@ -36,27 +84,30 @@ class InputDevice(IODevice):
             return
 
         # If there is no data ro read skip
-        if self.it >= len(self.input_data):
+        entry = self.peek()
+        if entry is None:
+            return
+        arrival, text = entry
+
+        # Data has not arrived yet, the device wakes up on arrival
+        if (self.control_unit is not None
+                and arrival > self.control_unit.tick):
+            self.control_unit.schedule_device(self.index, arrival)
             return
+        self.entry = None
 
         size, addr = self.get_buffer()
-        bytes_written = 0
-        while self.it < size and bytes_written < len(self.input_data[self.it]):
-            data = ord(self.input_data[self.it][bytes_written])
-            self.memory.cells[addr + bytes_written // 4] &= ~(
-                        0xFF000000 >> 8 * (bytes_written % 4))
-            self.memory.cells[addr + bytes_written // 4] |= data << (
-                    8 * (4 - bytes_written % 4 - 1))
-            bytes_written += 1
-        while bytes_written < size:
-            self.memory.cells[addr + bytes_written // 4] &= ~(
-                    0xFF000000 >> 8 * (bytes_written % 4))
-            bytes_written += 1
-
-        with open('out.txt', 'a') as file:
-            file.write(f"< {self.input_data[self.it][:bytes_written]}\n")
-        self.it += 1
+        # Entries longer than the buffer are truncated
+        text = text[:size]
+        try:
+            data = text.encode('latin-1')
+        except UnicodeEncodeError:
+            data = bytes(ord(char) & 0xFF for char in text)
+        self.memory.write_bytes(addr, data.ljust(size, b'\0'))
+
+        self.sink.write(f"< {text}")
         self.set_ready()
+        self.raise_interrupt()
 
 
 class Printer:
@@ -70,8 +121,8 @@ class OutputHandler:
 
 
 class OutputDevice(IODevice, OutputHandler, Printer):
-    def __init__(self, dev_id, registers, memory):
-        super().__init__(dev_id, registers, memory)
+    def __init__(self, dev_id, registers, memory, sink=None):
+        super().__init__(dev_id, registers, memory, sink)
 
     def process(self):
         # Data is not written by the processor yet
@@ -79,25 +130,18 @@ class OutputDevice(IODevice, OutputHandler, Printer):
             return
 
         size, addr = self.get_buffer()
-        data = []
-        bytes_read = 0
-        while bytes_read < size:
-            data.append((self.memory.cells[addr + bytes_read // 4] >> (
-                    8 * (4 - bytes_read % 4 - 1))) & 0xFF)
-            bytes_read += 1
+        data = self.memory.read_bytes(addr, size)
 
         self.output(self.convert_data(data))
         self.unset_ready()
+        self.raise_interrupt()
 
 
-# Converts data from memory buffer to a string
+# Converts bytes of a memory buffer to a string
 
 class StringPrinter(Printer):
     def convert_data(self, data):
-        res = ''.join(map(chr, data))
-        if res.find('\0') != -1:
-            return res[:res.find('\0')]
-        return res
+        return data.split(b'\0', 1)[0].decode('latin-1')
 
 
 class IntPrinter(Printer):
@@ -112,7 +156,7 @@ class UIntPrinter(Printer):
 
 class HexPrinter(Printer):
     def convert_data(self, data):
-        return ''.join(map(lambda x: f'{x:02X}', data))
+        return data.hex().upper()
 
 
 # Method to output data
@@ -120,53 +164,51 @@ class HexPrinter(Printer):
 class ConsolePrinter(OutputHandler):
     def output(self, data):
         print("Output:", data)
-        with open('out.txt', 'a') as file:
-            file.write(f"> {data}\n")
+        self.sink.write(f"> {data}")
 
 
 class FilePrinter(OutputHandler):
     def output(self, data):
-        with open('out.txt', 'a') as file:
-            file.write(f"> {data}\n")
+        self.sink.write(f"> {data}")
 
 
 # Output devices
 
 class StringConsoleOutputDevice(OutputDevice, StringPrinter, ConsolePrinter):
-    def __init__(self, dev_id, registers, memory):
-        super().__init__(dev_id, registers, memory)
+    def __init__(self, dev_id, registers, memory, sink=None):
+        super().__init__(dev_id, registers, memory, sink)
 
 
 class IntConsoleOutputDevice(OutputDevice, IntPrinter, ConsolePrinter):
-    def __init__(self, dev_id, registers, memory):
-        super().__init__(dev_id, registers, memory)
+    def __init__(self, dev_id, registers, memory, sink=None):
+        super().__init__(dev_id, registers, memory, sink)
 
 
 class UIntConsoleOutputDevice(OutputDevice, UIntPrinter, ConsolePrinter):
-    def __init__(self, dev_id, registers, memory):
-        super().__init__(dev_id, registers, memory)
+    def __init__(self, dev_id, registers, memory, sink=None):
+        super().__init__(dev_id, registers, memory, sink)
 
 
 class HexConsoleOutputDevice(OutputDevice, HexPrinter, ConsolePrinter):
-    def __init__(self, dev_id, registers, memory):
-        super().__init__(dev_id, registers, memory)
+    def __init__(self, dev_id, registers, memory, sink=None):
+        super().__init__(dev_id, registers, memory, sink)
 
 
 class StringFileOutputDevice(OutputDevice, StringPrinter, FilePrinter):
-    def __init__(self, dev_id, registers, memory):
-        super().__init__(dev_id, registers, memory)
+    def __init__(self, dev_id, registers, memory, sink=None):
+        super().__init__(dev_id, registers, memory, sink)
 
 
 class IntFileOutputDevice(OutputDevice, IntPrinter, FilePrinter):
-    def __init__(self, dev_id, registers, memory):
-        super().__init__(dev_id, registers, memory)
+    def __init__(self, dev_id, registers, memory, sink=None):
+        super().__init__(dev_id, registers, memory, sink)
 
 
 class UIntFileOutputDevice(OutputDevice, UIntPrinter, FilePrinter):
-    def __init__(self, dev_id, registers, memory):
-        super().__init__(dev_id, registers, memory)
+    def __init__(self, dev_id, registers, memory, sink=None):
+        super().__init__(dev_id, registers, memory, sink)
 
 
 class HexFileOutputDevice(OutputDevice, HexPrinter, FilePrinter):
-    def __init__(self, dev_id, registers, memory):
-        super().__init__(dev_id, registers, memory)
+    def __init__(self, dev_id, registers, memory, sink=None):
+        super().__init__(dev_id, registers, memory, sink)
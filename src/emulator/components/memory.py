@@ -1,4 +1,9 @@
+import mmap
 import re
+import sys
+from array import array
+
+from src.image import is_image, unpack_image
 
 
 def parse_line(line):
@@ -14,19 +19,154 @@ def parse_line(line):
         raise ValueError(f'Invalid line in operation codes: {line}')
 
 
+PAGE_BITS = 4
+
+STORAGE_PAGE_BITS = 12
+STORAGE_PAGE_SIZE = 1 << STORAGE_PAGE_BITS
+STORAGE_PAGE_MASK = STORAGE_PAGE_SIZE - 1
+
+
+# Cells split into fixed-size pages, a page is allocated on its first write
+# and untouched pages read as zero. Forks share pages until either side
+# writes into them
+class PagedCells:
+    def __init__(self, pages=None):
+        self.pages = {} if pages is None else pages
+        self.shared = set(self.pages)
+
+    def fork(self):
+        self.shared = set(self.pages)
+        return PagedCells(dict(self.pages))
+
+    def own_page(self, index):
+        page = self.pages.get(index)
+        if page is None:
+            page = array('I', bytes(STORAGE_PAGE_SIZE * 4))
+        elif index in self.shared:
+            page = array('I', page)
+        else:
+            return page
+        self.pages[index] = page
+        self.shared.discard(index)
+        return page
+
+    def __len__(self):
+        return 0x1000000
+
+    def __getitem__(self, addr):
+        if isinstance(addr, slice):
+            return [self[i] for i in range(*addr.indices(len(self)))]
+        page = self.pages.get(addr >> STORAGE_PAGE_BITS)
+        return 0 if page is None else page[addr & STORAGE_PAGE_MASK]
+
+    def __setitem__(self, addr, value):
+        if isinstance(addr, slice):
+            for i, word in zip(range(*addr.indices(len(self))), value):
+                self[i] = word
+            return
+        index = addr >> STORAGE_PAGE_BITS
+        page = self.pages.get(index)
+        if page is None or index in self.shared:
+            page = self.own_page(index)
+        page[addr & STORAGE_PAGE_MASK] = value
+
+
 class Memory:
-    def __init__(self, registry):
+    def __init__(self, registry, cells=None):
         self.size = 0x1000000
-        self.cells = [0] * self.size
+        # 32-bit words over an anonymous mapping, pages are allocated and
+        # zeroed by the OS on first touch
+        if cells is None:
+            cells = memoryview(mmap.mmap(-1, self.size * 4)).cast('I')
+        self.cells = cells
         self.registry = registry
+        # Watched cell ranges by page, see watch()
+        self.watches = {}
+        # Label addresses known from the loaded program
+        self.symbols = {}
 
     def read(self):
         self.registry.DR = self.cells[self.registry.AR & 0xFFFFFF]
 
     def write(self):
-        self.cells[self.registry.AR & 0xFFFFFF] = self.registry.DR
+        addr = self.registry.AR & 0xFFFFFF
+        self.cells[addr] = self.registry.DR
+        if addr >> PAGE_BITS in self.watches:
+            self.written(addr)
+
+    # Calls listener(addr, count) after cells overlapping
+    # [addr, addr + count) are written by write() or reported by written()
+    def watch(self, addr, count, listener):
+        entry = (addr, addr + count - 1, listener)
+        for page in range(addr >> PAGE_BITS,
+                          ((addr + count - 1) >> PAGE_BITS) + 1):
+            self.watches.setdefault(page, []).append(entry)
+
+    def unwatch(self, addr, count, listener):
+        entry = (addr, addr + count - 1, listener)
+        for page in range(addr >> PAGE_BITS,
+                          ((addr + count - 1) >> PAGE_BITS) + 1):
+            self.watches[page].remove(entry)
+            if not self.watches[page]:
+                del self.watches[page]
+
+    def watched(self, addr, count=1):
+        for page in range(addr >> PAGE_BITS,
+                          ((addr + count - 1) >> PAGE_BITS) + 1):
+            if page & (0xFFFFFF >> PAGE_BITS) in self.watches:
+                return True
+        return False
+
+    # Reports cells written directly through self.cells
+    def written(self, addr, count=1):
+        if not self.watches:
+            return
+        if addr + count > self.size:
+            self.written(addr, self.size - addr)
+            self.written(0, addr + count - self.size)
+            return
+        last = addr + count - 1
+        listeners = []
+        for page in range(addr >> PAGE_BITS, (last >> PAGE_BITS) + 1):
+            for entry in self.watches.get(page, ()):
+                start, end, listener = entry
+                if start <= last and end >= addr and entry not in listeners:
+                    listeners.append(entry)
+        # Listeners may change the watches
+        for start, end, listener in listeners:
+            listener(addr, count)
+
+    def read_words(self, addr, count):
+        return list(self.cells[addr:addr + count])
+
+    def write_words(self, addr, words):
+        self.cells[addr:addr + len(words)] = array('I', words)
+        self.written(addr, len(words))
+
+    # Device buffers hold bytes packed big-endian into words, a whole buffer
+    # is converted with a single byte swap
+    def read_bytes(self, addr, size):
+        words = array('I', self.cells[addr:addr + (size + 3) // 4])
+        if sys.byteorder == 'little':
+            words.byteswap()
+        return words.tobytes()[:size]
+
+    # The tail of the last word is kept
+    def write_bytes(self, addr, data):
+        count = (len(data) + 3) // 4
+        buffer = bytearray(self.read_bytes(addr, count * 4))
+        buffer[:len(data)] = data
+        words = array('I', bytes(buffer))
+        if sys.byteorder == 'little':
+            words.byteswap()
+        self.cells[addr:addr + count] = words
+        self.written(addr, count)
 
     def load(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self.load_image(data)
+            return
+
         # Handle CRLF, CR, LF line endings
         for line in data.replace('\r\n', '\n').replace('\r', '\n').split('\n'):
             if line == '':
@@ -39,4 +179,28 @@ class Memory:
                     self.registry.PC = int(address, 16)
                     print('Entry point set to', hex(self.registry.PC))
 
+                if comment.startswith('<-'):
+                    self.symbols[comment[2:].strip()] = int(address, 16)
+
                 self.cells[int(address, 16)] = int(value, 16)
+
+    # Binary image segments are copied with a single slice assignment each
+    def load_image(self, data):
+        if not is_image(data):
+            raise ValueError('Invalid program image')
+        entry, segments, symbols = unpack_image(data)
+        self.symbols.update(symbols)
+        if entry is not None:
+            self.registry.PC = entry
+            print('Entry point set to', hex(self.registry.PC))
+        for start, words in segments:
+            self.cells[start:start + len(words)] = words
+
+
+class PagedMemory(Memory):
+    def __init__(self, registry, cells=None):
+        super().__init__(registry, PagedCells() if cells is None else cells)
+
+    # Copy-on-write snapshot of the memory bound to another registry
+    def fork(self, registry):
+        return PagedMemory(registry, self.cells.fork())
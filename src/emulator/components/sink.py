@@ -0,0 +1,76 @@
+import sys
+
+SINK_BUFFER_SIZE = 1 << 16
+
+
+# Transcript of device transfers kept open for the whole run, the base sink
+# discards everything
+class Sink:
+    def write(self, line):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class FileSink(Sink):
+    def __init__(self, path, buffer_size=SINK_BUFFER_SIZE):
+        self.file = open(path, 'w', buffering=buffer_size)
+
+    def write(self, line):
+        self.file.write(line + '\n')
+
+    def flush(self):
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# Stream owned by someone else, stdout by default, it is never closed
+class StreamSink(Sink):
+    def __init__(self, stream=None):
+        self.stream = stream if stream is not None else sys.stdout
+
+    def write(self, line):
+        self.stream.write(line + '\n')
+
+    def flush(self):
+        self.stream.flush()
+
+
+class ListSink(Sink):
+    def __init__(self):
+        self.lines = []
+
+    def write(self, line):
+        self.lines.append(line)
+
+
+class CallbackSink(Sink):
+    def __init__(self, callback):
+        self.callback = callback
+
+    def write(self, line):
+        self.callback(line)
+
+
+# '-' is stdout, anything else a file path
+def open_sink(path):
+    if path is None:
+        return Sink()
+    if path == '-':
+        return StreamSink()
+    return FileSink(path)
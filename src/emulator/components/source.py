@@ -0,0 +1,63 @@
+import sys
+
+
+# Entries of an input device, pulled one at a time when the device is ready
+# for the next one. The base source wraps any iterable
+class Source:
+    def __init__(self, entries=()):
+        self.entries = entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Lines of a text file without their line breaks, the file is closed with
+# the source unless it was opened by someone else (stdin)
+class LineSource(Source):
+    def __init__(self, file, owned=True):
+        super().__init__()
+        self.file = file
+        self.owned = owned
+
+    def __iter__(self):
+        for line in self.file:
+            yield line.rstrip('\n')
+
+    def close(self):
+        if self.owned and self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+# Fixed-size chunks of a text file, line breaks included
+class ChunkSource(LineSource):
+    def __init__(self, file, chunk_size, owned=True):
+        super().__init__(file, owned)
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        while True:
+            chunk = self.file.read(self.chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+# '-' is stdin, anything else a file or a named pipe path
+def open_source(path, chunk_size=None):
+    if path == '-':
+        file, owned = sys.stdin, False
+    else:
+        file, owned = open(path, 'r'), True
+    if chunk_size is None:
+        return LineSource(file, owned)
+    return ChunkSource(file, chunk_size, owned)
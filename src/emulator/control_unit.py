@@ -1,7 +1,16 @@
-import time
+import math
 from enum import Enum
+from functools import partial
 
-from src.emulator.mc_mnemonic_parser import parse_mnemonic
+from src.emulator.budget import Budget, LimitExceeded
+from src.emulator.flight_recorder import FlightRecorder
+from src.emulator.idle_loop import IdleLoopDetector
+from src.emulator.interrupt_controller import InterruptController
+from src.emulator.pacer import Pacer
+from src.emulator.microcode import rom, SEQUENCER_WORD, \
+    SEQUENCER_SHIFT, SequencerOperations
+from src.emulator.trace import TraceLevel, TraceFormat, OverflowPolicy, \
+    format_state, open_trace
 
 
 class AdrrMode(Enum):
@@ -28,8 +37,8 @@ class AddrCommands(Enum):
     JLE = 0x9C
     CALL = 0xA0
     PUSH = 0xA4
-    SET = 0xF0,
-    UNSET = 0xF4,
+    SET = 0xF0
+    UNSET = 0xF4
     CHECK = 0xFC
 
 
@@ -115,6 +124,84 @@ non_address_commands = {
 }
 
 
+# Microprograms of the instructions, XOR has no microcode yet
+instruction_microprograms = {
+    NonAddrCommands.NOP: 'nop',
+    NonAddrCommands.POP: 'pop',
+    NonAddrCommands.PUSHF: 'pushf',
+    NonAddrCommands.POPF: 'popf',
+    NonAddrCommands.INC: 'inc',
+    NonAddrCommands.DEC: 'dec',
+    NonAddrCommands.SWAP: 'swap',
+    NonAddrCommands.DUP: 'dup',
+    NonAddrCommands.RET: 'ret',
+    NonAddrCommands.HALT: 'halt',
+    NonAddrCommands.IRET: 'iret',
+    NonAddrCommands.EI: 'ei',
+    NonAddrCommands.DI: 'di',
+    NonAddrCommands.ADD: 'add',
+    NonAddrCommands.SUB: 'sub',
+    NonAddrCommands.MUL: 'mul',
+    NonAddrCommands.DIV: 'div',
+    NonAddrCommands.AND: 'and',
+    NonAddrCommands.OR: 'or',
+    NonAddrCommands.XOR: 'nop',
+    NonAddrCommands.NOT: 'not',
+    NonAddrCommands.NEG: 'neg',
+    NonAddrCommands.SHL: 'shl',
+    NonAddrCommands.SHR: 'shr',
+    NonAddrCommands.ROL: 'rol',
+    NonAddrCommands.ROR: 'ror',
+    NonAddrCommands.CMP: 'cmp',
+    NonAddrCommands.LD: 'ld',
+    NonAddrCommands.ST: 'st',
+    AddrCommands.JMP: 'jmp',
+    AddrCommands.JZ: 'jz',
+    AddrCommands.JE: 'je',
+    AddrCommands.JNZ: 'jnz',
+    AddrCommands.JG: 'jg',
+    AddrCommands.JGE: 'jge',
+    AddrCommands.JL: 'jl',
+    AddrCommands.JLE: 'jle',
+    AddrCommands.CALL: 'call',
+    AddrCommands.PUSH: 'push',
+    AddrCommands.SET: 'set',
+    AddrCommands.UNSET: 'unset',
+    AddrCommands.CHECK: 'check',
+}
+
+
+def build_dispatch_table():
+    table = [None] * 0x100
+    for opcode, instruction in non_address_commands.items():
+        table[opcode] = rom[instruction_microprograms[instruction]]
+    # Addressing mode bits are not decoded, all modes share a microprogram
+    for opcode, instruction in address_commands.items():
+        for mode in range(4):
+            table[opcode | mode] = rom[
+                instruction_microprograms[instruction]]
+    return table
+
+
+# Flat microprogram for every opcode byte
+dispatch_table = build_dispatch_table()
+
+# Instructions writing an arbitrary cell, reported through memory.written
+arbitrary_stores = {'st', 'set', 'unset'}
+
+
+def build_store_opcodes():
+    opcodes = {opcode for opcode, instruction in non_address_commands.items()
+               if instruction_microprograms[instruction] in arbitrary_stores}
+    for opcode, instruction in address_commands.items():
+        if instruction_microprograms[instruction] in arbitrary_stores:
+            opcodes.update(opcode | mode for mode in range(4))
+    return opcodes
+
+
+store_opcodes = build_store_opcodes()
+
+
 class ControlUnit:
     def __init__(self, registers, memory, data_path, io_devices):
         self.registers = registers
@@ -122,378 +209,53 @@ class ControlUnit:
         self.memory = memory
         self.tick = 0
         self.instruction = 0
+        # Tick of the next pacer or budget checkpoint of a run
+        self.end_tick = math.inf
+        # Ticks of idle loop iterations skipped by fast-forwarding
+        self.skipped_ticks = 0
         self.io_devices = io_devices
-
-    def execute_mnemonic(self, mnemonic):
-        code = parse_mnemonic(mnemonic)
-        self.data_path.execute(code)
-        self.inc_tick()
-
-    def execute_addr_instruction(self, opcode):
-        instruction = address_commands[opcode]
-        if instruction == AddrCommands.PUSH:
-            self.execute_push()
-        elif instruction == AddrCommands.JMP:
-            self.execute_jmp()
-        elif instruction == AddrCommands.JZ:
-            self.execute_jz()
-        elif instruction == AddrCommands.JE:
-            self.execute_je()
-        elif instruction == AddrCommands.JNZ:
-            self.execute_jnz()
-        elif instruction == AddrCommands.JG:
-            self.execute_jg()
-        elif instruction == AddrCommands.JGE:
-            self.execute_jge()
-        elif instruction == AddrCommands.JL:
-            self.execute_jl()
-        elif instruction == AddrCommands.JLE:
-            self.execute_jle()
-        elif instruction == AddrCommands.CALL:
-            self.execute_call()
-        elif instruction == AddrCommands.SET:
-            self.execute_set()
-        elif instruction == AddrCommands.UNSET:
-            self.execute_unset()
-        elif instruction == AddrCommands.CHECK:
-            self.execute_check()
-
-    def execute_non_addr_instruction(self, opcode):
-        instruction = non_address_commands[opcode]
-        if instruction == NonAddrCommands.HALT:
-            self.execute_halt()
-        elif instruction == NonAddrCommands.NOP:
-            self.execute_nop()
-        elif instruction == NonAddrCommands.POP:
-            self.execute_pop()
-        elif instruction == NonAddrCommands.PUSHF:
-            self.execute_pushf()
-        elif instruction == NonAddrCommands.POPF:
-            self.execute_popf()
-        elif instruction == NonAddrCommands.INC:
-            self.execute_inc()
-        elif instruction == NonAddrCommands.DEC:
-            self.execute_dec()
-        elif instruction == NonAddrCommands.SWAP:
-            self.execute_swap()
-        elif instruction == NonAddrCommands.DUP:
-            self.execute_dup()
-        elif instruction == NonAddrCommands.RET:
-            self.execute_ret()
-        elif instruction == NonAddrCommands.IRET:
-            self.execute_iret()
-        elif instruction == NonAddrCommands.EI:
-            self.execute_ei()
-        elif instruction == NonAddrCommands.DI:
-            self.execute_di()
-        elif instruction == NonAddrCommands.ADD:
-            self.execute_add()
-        elif instruction == NonAddrCommands.SUB:
-            self.execute_sub()
-        elif instruction == NonAddrCommands.MUL:
-            self.execute_mul()
-        elif instruction == NonAddrCommands.DIV:
-            self.execute_div()
-        elif instruction == NonAddrCommands.AND:
-            self.execute_and()
-        elif instruction == NonAddrCommands.OR:
-            self.execute_or()
-        elif instruction == NonAddrCommands.NOT:
-            self.execute_not()
-        elif instruction == NonAddrCommands.NEG:
-            self.execute_neg()
-        elif instruction == NonAddrCommands.SHL:
-            self.execute_shl()
-        elif instruction == NonAddrCommands.SHR:
-            self.execute_shr()
-        elif instruction == NonAddrCommands.ROL:
-            self.execute_rol()
-        elif instruction == NonAddrCommands.ROR:
-            self.execute_ror()
-        elif instruction == NonAddrCommands.CMP:
-            self.execute_cmp()
-        elif instruction == NonAddrCommands.LD:
-            self.execute_ld()
-        elif instruction == NonAddrCommands.ST:
-            self.execute_st()
-
-    # Non addr instructions implementation
-    def execute_halt(self):
-        # TODO adjust implementation for microcode
-        self.registers.SR &= 0x7FFF
-        self.inc_tick()
-
-    def execute_nop(self):
-        pass
-
-    def execute_pop(self):
-        self.execute_mnemonic('SP + 1 -> SP')
-
-    def execute_pushf(self):
-        self.execute_mnemonic('SP + ~0 -> SP, AR')
-        self.execute_mnemonic('SR -> DR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_inc(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR + 1 -> DR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_dec(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR + ~0 -> DR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_swap(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> BR')
-        self.execute_mnemonic('SP + 1 -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-        self.execute_mnemonic('BR -> DR')
-        self.execute_mnemonic('SP + 1 -> AR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_popf(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> SR')
-        self.execute_mnemonic('SP + 1 -> SP')
-
-    def execute_dup(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('SP + ~0 -> SP, AR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_ret(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> PC')
-        self.execute_mnemonic('SP + 1 -> SP')
-
-    def execute_iret(self):
-        self.execute_popf()
-        self.execute_ret()
-
-    def execute_ei(self):
-        # TODO adjust implementation for microcode
-        self.registers.SR |= 0x4000
-        self.inc_tick()
-
-    def execute_di(self):
-        # TODO adjust implementation for microcode
-        self.registers.SR &= 0xBFFF
-        self.inc_tick()
-
-    def execute_add(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> BR')
-        self.execute_mnemonic('SP + 1 -> AR, SP')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('BR + DR -> DR {NZVC}')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_sub(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> BR')
-        self.execute_mnemonic('SP + 1 -> AR, SP')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('BR + ~DR+1 -> DR {NZVC}')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_mul(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> BR')
-        self.execute_mnemonic('SP + 1 -> AR, SP')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('BR * DR -> DR {NZVC}')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_div(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> BR')
-        self.execute_mnemonic('SP + 1 -> AR, SP')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('BR / DR -> DR {NZVC}')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_and(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> BR')
-        self.execute_mnemonic('SP + 1 -> AR, SP')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('BR & DR -> DR {NZ}')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_or(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> BR')
-        self.execute_mnemonic('SP + 1 -> AR, SP')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('~BR & ~DR -> DR')
-        self.execute_mnemonic('~DR -> DR {NZ}')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_not(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('~DR -> DR {NZ}')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_neg(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('~DR+1 -> DR {NZ}')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_shl(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('SHL(DR) -> DR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_shr(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('SHR(DR) -> DR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_rol(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('ROL(DR) -> DR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_ror(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('ROR(DR) -> DR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_cmp(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> BR')
-        self.execute_mnemonic('SP + 1 -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('BR + ~DR+1 -> BR {NZVC}')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_ld(self):
-        self.execute_mnemonic('SP -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('SP + ~0 -> AR, SP')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_st(self):
-        self.execute_mnemonic('SP + 1 -> AR, SP')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> BR')
-        self.execute_mnemonic('SP + ~0 -> AR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('BR -> AR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    # Non Addr instructions implementation
-
-    def execute_push(self):
-        self.execute_mnemonic('CUTB(CR) -> DR')
-        self.execute_mnemonic('SP + ~0 -> SP, AR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-
-    def execute_jmp(self):
-        self.execute_mnemonic('CUTB(CR) -> PC')
-
-    def execute_jz(self):
-        if (self.registers.SR & 0x4) == 0:
-            return
-        self.execute_mnemonic('CUTB(CR) -> PC')
-
-    def execute_je(self):
-        if (self.registers.SR & 0x4) == 0:
-            return
-        self.execute_mnemonic('CUTB(CR) -> PC')
-
-    def execute_jnz(self):
-        if (self.registers.SR & 0x4) != 0:
-            return
-        self.execute_mnemonic('CUTB(CR) -> PC')
-
-    def execute_jg(self):
-        if (self.registers.SR & 0x8) != 0:
-            return
-        self.execute_mnemonic('CUTB(CR) -> PC')
-
-    def execute_jge(self):
-        if (self.registers.SR & 0x8) != 0 and (self.registers.SR & 0x4) == 0:
-            return
-        self.execute_mnemonic('CUTB(CR) -> PC')
-
-    def execute_jl(self):
-        if (self.registers.SR & 0x8) == 0:
-            return
-        self.execute_mnemonic('CUTB(CR) -> PC')
-
-    def execute_jle(self):
-        if (self.registers.SR & 0x8) == 0 and (self.registers.SR & 0x4) == 0:
-            return
-        self.execute_mnemonic('CUTB(CR) -> PC')
-
-    def execute_call(self):
-        self.execute_mnemonic('SP + ~0 -> SP, AR')
-        self.execute_mnemonic('PC -> DR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-        self.execute_mnemonic('CUTB(CR) -> PC')
-
-    def execute_set(self):
-        self.execute_push()
-        self.execute_ld()
-        self.execute_mnemonic('SP + ~0 -> SP, AR')
-        self.execute_mnemonic('BR & ~BR -> BR')
-        self.execute_mnemonic('BR + 1 -> DR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-        self.execute_ror()
-        self.execute_or()
-        self.execute_st()
-        self.execute_pop()
-
-    def execute_unset(self):
-        self.execute_push()
-        self.execute_ld()
-        self.execute_mnemonic('SP + ~0 -> SP, AR')
-        self.execute_mnemonic('BR & ~BR -> BR')
-        self.execute_mnemonic('BR + 1 -> DR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-        self.execute_ror()
-        self.execute_not()
-        self.execute_and()
-        self.execute_st()
-        self.execute_pop()
-
-    def execute_check(self):
-        self.execute_push()
-        self.execute_ld()
-        self.execute_mnemonic('SP + ~0 -> SP, AR')
-        self.execute_mnemonic('BR & ~BR -> BR')
-        self.execute_mnemonic('BR + 1 -> DR')
-        self.execute_mnemonic('DR -> MEM(AR)')
-        self.execute_ror()
-        self.execute_and()
-        self.execute_pop()
-        self.execute_pop()
+        # Devices only react to their own cells, they are processed after
+        # those were written
+        self.pending_devices = set(range(len(io_devices)))
+        # Devices waiting for a tick (input arrival) and the earliest of them
+        self.scheduled_devices = {}
+        self.next_device_event = math.inf
+        # Transfers done by the devices, an idle loop sees none
+        self.device_activity = 0
+        self.interrupt_controller = InterruptController()
+        for index, device in enumerate(io_devices):
+            device.watch(partial(self.wake_device, index))
+            device.attach(self, index)
+        # Executes a data path word, replaced to trace micro-steps
+        self.execute_micro_step = data_path.execute
+        self.trace = None
+        # Polls the flight recorder triggers before devices are handled,
+        # None when no trigger is polled
+        self.poll_triggers = None
+
+    # Micro-PC loop, walks a flat microprogram word by word
+    def execute_microprogram(self, program):
+        execute = self.execute_micro_step
+        for word in program:
+            if word < SEQUENCER_WORD:
+                execute(word)
+                self.tick += 1
+                continue
+
+            operation = word >> SEQUENCER_SHIFT
+            data = word & 0xFFFF
+            if operation == SequencerOperations.BRANCH.value:
+                mask = (data >> 4) & 0xF
+                value = data & 0xF
+                negate = (data >> 8) & 1 != 0
+                if (self.registers.SR & mask == value) == negate:
+                    return
+            elif operation == SequencerOperations.SET_SR.value:
+                self.registers.SR |= data
+                self.tick += 1
+            elif operation == SequencerOperations.RESET_SR.value:
+                self.registers.SR &= ~data & 0xFFFF
+                self.tick += 1
 
     def inc_tick(self):
         self.tick += 1
@@ -505,48 +267,184 @@ class ControlUnit:
         return (self.registers.SR & 0x8000) != 0
 
     def fetch_instruction(self):
-        self.execute_mnemonic('PC -> AR, BR')
-        self.execute_mnemonic('MEM(AR) -> DR')
-        self.execute_mnemonic('DR -> CR')
-        self.execute_mnemonic('BR + 1 -> PC')
+        self.execute_microprogram(rom['fetch'])
 
     def execute_instruction(self):
         opcode = self.registers.CR >> 24
-        if opcode & 0x80 != 0:
-            opcode &= 0b11111100
-            self.execute_addr_instruction(opcode)
-        else:
-            self.execute_non_addr_instruction(opcode)
+        program = dispatch_table[opcode]
+        if program is None:
+            raise ValueError(f'Invalid opcode: {opcode:02X}')
+        self.execute_microprogram(program)
+
+    def wake_device(self, index, addr, count):
+        self.pending_devices.add(index)
+
+    def schedule_device(self, index, tick):
+        self.scheduled_devices[index] = tick
+        self.next_device_event = min(self.scheduled_devices.values())
+
+    def wake_scheduled_devices(self):
+        for index, tick in list(self.scheduled_devices.items()):
+            if tick <= self.tick:
+                del self.scheduled_devices[index]
+                self.pending_devices.add(index)
+        self.next_device_event = min(self.scheduled_devices.values(),
+                                     default=math.inf)
 
     def handle_devices(self):
-        for device in self.io_devices:
-            device.process()
+        if self.poll_triggers is not None:
+            self.poll_triggers(self)
+        if self.tick >= self.next_device_event:
+            self.wake_scheduled_devices()
+        if not self.pending_devices:
+            return
+        pending = sorted(self.pending_devices)
+        self.pending_devices.clear()
+        for index in pending:
+            self.io_devices[index].process()
+
+    # Enters the handler of the lowest pending device, its vector cell is
+    # loaded into CR for the entry microprogram
+    def enter_interrupt(self):
+        dev_id = self.interrupt_controller.acknowledge()
+        self.registers.CR = self.memory.cells[dev_id * 2]
+        self.execute_microprogram(rom['interrupt'])
 
     def process(self):
         self.fetch_instruction()
         self.execute_instruction()
         self.handle_devices()
         self.inc_instruction()
+        if (self.interrupt_controller.pending
+                and self.registers.SR & 0xC000 == 0xC000):
+            self.enter_interrupt()
+
+    # Runs a single instruction, engines running several at once in
+    # process() step one for the traces
+    def step_instruction(self):
+        self.process()
+
+    # Steps until the processor halts or reaches the tick, untraced runs go
+    # in batches between checkpoints
+    def run_until(self, tick):
+        while self.check_stop_flag() and self.tick < tick:
+            self.process()
+
+    def snapshot(self):
+        registers = self.registers
+        cells = self.memory.cells
+        return (
+            self.tick,
+            self.instruction,
+            registers.PC & 0xFFFFFF,
+            registers.SP & 0xFFFFFF,
+            registers.CR & 0xFFFFFFFF,
+            registers.AR & 0xFFFFFF,
+            registers.DR & 0xFFFFFFFF,
+            registers.SR & 0xFFFF,
+            registers.BR & 0xFFFFFFFF,
+            cells[registers.SP & 0xFFFFFF],
+            cells[(registers.SP + 1) & 0xFFFFFF]
+        )
 
     def print_state(self):
+        return format_state(self.snapshot())
+
+    def print_micro_state(self, word):
+        # Tick is counted after the step returns
         return (
-            f'Tick: {self.tick} \t'
-            f'| Instruction: {self.instruction}   '
-            f'| {self.registers} '
-            f'| TOS: '
-            f'{self.memory.cells[self.registers.SP & 0xFFFFFF]:08X} '
-            f'| NOS: '
-            f'{self.memory.cells[(self.registers.SP + 1) & 0xFFFFFF]:08X}'
+            f'Tick: {self.tick + 1} \t'
+            f'| Micro: {word:010X} '
+            f'| {self.registers}'
         )
 
-    def run(self, instruction_delay):
-        with open('sources.txt', 'w') as golden_file:
+    def trace_micro_step(self, word):
+        self.data_path.execute(word)
+        self.trace.write(self.print_micro_state(word))
+
+    # Paces the clock and checks the limits, returns the tick of the next
+    # checkpoint
+    def checkpoint(self, pacer, budget):
+        self.end_tick = min(pacer.pace(self.tick), budget.check(self))
+        return self.end_tick
+
+    def run(self, frequency=None, trace_level=TraceLevel.INSTRUCTION,
+            trace_path='sources.txt', trace_format=TraceFormat.TEXT,
+            trace_queue=0, trace_overflow=OverflowPolicy.BLOCK,
+            trace_window=1024, trace_post_window=0, trace_triggers=(),
+            fast_forward=False, budget=None):
+        if trace_level == TraceLevel.OFF:
+            trace_path = None
+        if (trace_level == TraceLevel.MICRO_STEP
+                and trace_format != TraceFormat.TEXT):
+            raise ValueError('Micro-steps are traced only as text')
+        trace = open_trace(trace_path, trace_format, trace_queue,
+                           trace_overflow)
+        if trace_level == TraceLevel.FLIGHT:
+            trace = FlightRecorder(trace, trace_window, trace_post_window,
+                                   trace_triggers)
+        pacer = Pacer(frequency)
+        if budget is None:
+            budget = Budget()
+        # Traces record a state after every instruction, skipped idle
+        # iterations leave no trace
+        step = self.process
+        if trace_level in (TraceLevel.INSTRUCTION, TraceLevel.MICRO_STEP,
+                           TraceLevel.FLIGHT):
+            step = self.step_instruction
+        detector = None
+        if fast_forward:
+            detector = IdleLoopDetector(self, store_opcodes, step)
+            step = detector.process
+        exceeded = None
+        with trace:
+            self.trace = trace
+            if trace_level == TraceLevel.MICRO_STEP:
+                self.execute_micro_step = self.trace_micro_step
+            if trace_level == TraceLevel.FLIGHT:
+                trace.attach(self.memory)
+                if trace.triggers:
+                    self.poll_triggers = trace.poll
             self.registers.SR |= 0x8000
-            while self.check_stop_flag():
-                self.process()
-                # print(self.print_state())
-                golden_file.write(self.print_state() + '\n')
-                time.sleep(instruction_delay / 1000)
+            try:
+                next_tick = self.end_tick = min(pacer.start(self.tick),
+                                                budget.start(self))
+                if trace_level in (TraceLevel.INSTRUCTION,
+                                   TraceLevel.MICRO_STEP, TraceLevel.FLIGHT):
+                    record = trace.record
+                    while self.check_stop_flag():
+                        step()
+                        record(self.snapshot())
+                        if self.tick >= next_tick:
+                            next_tick = self.checkpoint(pacer, budget)
+                elif detector is not None:
+                    while self.check_stop_flag():
+                        step()
+                        if self.tick >= next_tick:
+                            next_tick = self.checkpoint(pacer, budget)
+                else:
+                    while self.check_stop_flag():
+                        self.run_until(next_tick)
+                        if self.tick >= next_tick:
+                            next_tick = self.checkpoint(pacer, budget)
+            except LimitExceeded as error:
+                exceeded = error
+                print(error)
+                if trace_level == TraceLevel.FLIGHT:
+                    trace.dump(str(error))
+            if trace_level == TraceLevel.HALT:
+                trace.record(self.snapshot())
+            for device in self.io_devices:
+                device.flush()
+            self.execute_micro_step = self.data_path.execute
+            self.end_tick = math.inf
+            self.poll_triggers = None
+            self.trace = None
+            if detector is not None and detector.skipped_ticks:
+                self.skipped_ticks += detector.skipped_ticks
+                print(f'Idle loops fast-forwarded by '
+                      f'{detector.skipped_ticks} ticks')
             print(
                 f'Emulation finished in {self.tick} ticks '
                 f'/ {self.instruction} instruction executions')
+        return exceeded
@@ -1,7 +1,9 @@
 from enum import Enum
+from operator import attrgetter
 
-from src.emulator.components.alu import process_alu_code
-from src.emulator.components.commutator import process_commutator_code
+from src.emulator.components.alu import alu_kernel
+from src.emulator.components.commutator import commutator_kernel, \
+    commutator_sets_flags
 
 
 class DataPathOperations(Enum):
@@ -63,6 +65,71 @@ def gen_io_write(device):
                     | DataPathOperations.DEV_FLAGS) << 30) | device
 
 
+register_names = {
+    RegisterCodes.PC.value: 'PC',
+    RegisterCodes.SP.value: 'SP',
+    RegisterCodes.CR.value: 'CR',
+    RegisterCodes.AR.value: 'AR',
+    RegisterCodes.DR.value: 'DR',
+    RegisterCodes.SR.value: 'SR',
+    RegisterCodes.BR.value: 'BR'
+}
+
+
+def decode_registers(registers):
+    return tuple(name for code, name in register_names.items()
+                 if registers & code != 0)
+
+
+def gen_register_getter(registers):
+    names = decode_registers(registers)
+    if len(names) == 0:
+        return None
+    if len(names) == 1:
+        return attrgetter(names[0])
+
+    get_values = attrgetter(*names)
+
+    def get_value(registry):
+        val = 0
+        for value in get_values(registry):
+            val |= value
+        return val
+
+    return get_value
+
+
+# Decoded form of a microcode word
+class MicroOperation:
+    __slots__ = ('op', 'device', 'lhs', 'rhs', 'targets', 'alu_code',
+                 'commutator_code', 'alu', 'commutator')
+
+    def __init__(self, code):
+        self.op = (code >> 37) & 0b111
+        self.device = self.op & 0xFF
+        self.lhs = gen_register_getter((code >> 23) & 0b1111111)
+        self.rhs = gen_register_getter((code >> 16) & 0b1111111)
+        self.targets = decode_registers((code >> 30) & 0b1111111)
+        self.alu_code = (code >> 10) & 0b111111
+        self.commutator_code = code & 0b1111111111
+        # Flags are computed only if the commutator stores them
+        self.alu = alu_kernel(self.alu_code,
+                              commutator_sets_flags(self.commutator_code))
+        self.commutator = commutator_kernel(self.commutator_code)
+
+
+# Microcode words are decoded only once, on the first execution
+micro_operations = {}
+
+
+def decode_micro_operation(code):
+    micro_operation = micro_operations.get(code)
+    if micro_operation is None:
+        micro_operation = MicroOperation(code)
+        micro_operations[code] = micro_operation
+    return micro_operation
+
+
 class DataPath:
     def __init__(self, memory, registry, devices):
         self.registry = registry
@@ -75,65 +142,33 @@ class DataPath:
         pass
 
     def execute(self, code):
-        op = (code >> 37) & 0b111
-        if (op & DataPathOperations.READ.value != 0
-                and op & DataPathOperations.DEV_FLAGS.value != 0):
-            self.memory.io_read(op & 0xFF)
-            return
-        if (op & DataPathOperations.WRITE.value != 0
-                and op & DataPathOperations.DEV_FLAGS.value != 0):
-            self.memory.io_write(op & 0xFF)
-            return
-        if op & DataPathOperations.READ.value != 0:
-            self.memory.read()
-            return
-        if op & DataPathOperations.WRITE.value != 0:
-            self.memory.write()
-            return
-
-        target = (code >> 30) & 0b1111111
-        lhs_code = (code >> 23) & 0b1111111
-        rhs_code = (code >> 16) & 0b1111111
-
-        def get_value(registers):
-            val = 0
-            if registers & RegisterCodes.PC.value != 0:
-                val |= self.registry.PC
-            if registers & RegisterCodes.SP.value != 0:
-                val |= self.registry.SP
-            if registers & RegisterCodes.CR.value != 0:
-                val |= self.registry.CR
-            if registers & RegisterCodes.AR.value != 0:
-                val |= self.registry.AR
-            if registers & RegisterCodes.DR.value != 0:
-                val |= self.registry.DR
-            if registers & RegisterCodes.SR.value != 0:
-                val |= self.registry.SR
-            if registers & RegisterCodes.BR.value != 0:
-                val |= self.registry.BR
-            return val
-
-        lhs = get_value(lhs_code)
-        rhs = get_value(rhs_code)
-
-        alu_code = (code >> 10) & 0b111111
-        commutator_code = code & 0b1111111111
-
-        res, flags = process_alu_code(lhs, rhs, alu_code)
-        res = process_commutator_code(res, commutator_code, flags,
-                                      self.registry)
-
-        if target & RegisterCodes.PC.value != 0:
-            self.registry.PC = res
-        if target & RegisterCodes.SP.value != 0:
-            self.registry.SP = res
-        if target & RegisterCodes.CR.value != 0:
-            self.registry.CR = res
-        if target & RegisterCodes.AR.value != 0:
-            self.registry.AR = res
-        if target & RegisterCodes.DR.value != 0:
-            self.registry.DR = res
-        if target & RegisterCodes.SR.value != 0:
-            self.registry.SR = res
-        if target & RegisterCodes.BR.value != 0:
-            self.registry.BR = res
+        micro_operation = micro_operations.get(code)
+        if micro_operation is None:
+            micro_operation = decode_micro_operation(code)
+
+        op = micro_operation.op
+        if op != DataPathOperations.NONE.value:
+            if (op & DataPathOperations.READ.value != 0
+                    and op & DataPathOperations.DEV_FLAGS.value != 0):
+                self.memory.io_read(micro_operation.device)
+                return
+            if (op & DataPathOperations.WRITE.value != 0
+                    and op & DataPathOperations.DEV_FLAGS.value != 0):
+                self.memory.io_write(micro_operation.device)
+                return
+            if op & DataPathOperations.READ.value != 0:
+                self.memory.read()
+                return
+            if op & DataPathOperations.WRITE.value != 0:
+                self.memory.write()
+                return
+
+        registry = self.registry
+        lhs = micro_operation.lhs(registry) if micro_operation.lhs else 0
+        rhs = micro_operation.rhs(registry) if micro_operation.rhs else 0
+
+        res, flags = micro_operation.alu(lhs, rhs)
+        res = micro_operation.commutator(res, flags, registry)
+
+        for target in micro_operation.targets:
+            setattr(registry, target, res)
@@ -1,55 +1,257 @@
 import argparse
 
+from src.emulator.block_unit import BlockControlUnit
+from src.emulator.budget import Budget, Cancelled
 from src.emulator.components.io_device import InputDevice, \
     StringConsoleOutputDevice, IntConsoleOutputDevice, \
     UIntConsoleOutputDevice, HexConsoleOutputDevice, StringFileOutputDevice, \
     IntFileOutputDevice, UIntFileOutputDevice, \
     HexFileOutputDevice
-from src.emulator.components.memory import Memory
+from src.emulator.components.memory import Memory, PagedMemory
 from src.emulator.components.registers import Registry
+from src.emulator.components.sink import ListSink, open_sink
+from src.emulator.components.source import Source, open_source
 from src.emulator.control_unit import ControlUnit
 from src.emulator.data_path import DataPath
+from src.emulator.flight_recorder import parse_trigger
+from src.emulator.functional_unit import FunctionalControlUnit
+from src.emulator.trace import TraceLevel, TraceFormat, OverflowPolicy
+from src.image import is_image
 
+engines = {
+    'microcode': ControlUnit,
+    'functional': FunctionalControlUnit,
+    'block': BlockControlUnit
+}
 
-def main(opcodes, input_queue=None):
-    with open(opcodes, 'r', encoding='utf-8') as file:
-        operation_codes = file.read()
+memory_models = {
+    'flat': Memory,
+    'paged': PagedMemory
+}
 
-    with open('out.txt', 'w') as file:
-        file.truncate(0)
 
-    print('Emulator started...')
+# Output devices by id, device 0 reads the input
+output_devices = [
+    StringConsoleOutputDevice,
+    IntConsoleOutputDevice,
+    UIntConsoleOutputDevice,
+    HexConsoleOutputDevice,
+    StringFileOutputDevice,
+    IntFileOutputDevice,
+    UIntFileOutputDevice,
+    HexFileOutputDevice
+]
+
+
+# Program is a path, the bytes of an image or of operation codes, or a
+# generator that produced its code
+def read_program(program):
+    if hasattr(program, 'generate_image'):
+        return program.generate_image()
+    if isinstance(program, (bytes, bytearray, memoryview)):
+        data = bytes(program)
+    else:
+        with open(program, 'rb') as file:
+            data = file.read()
+    if not is_image(data):
+        data = data.decode('utf-8')
+    return data
+
+
+# Outcome of a run: status is 'halted', 'limit' or 'cancelled', io holds
+# the transcript when it was kept in memory. A stopped run names its limit
+# and the PC it stopped at, skipped_ticks counts the ticks fast-forwarded
+# over idle loops
+class EmulationResult:
+    def __init__(self, status, tick, instruction, registers, io=None,
+                 trace_path=None, error=None, limit=None, pc=None,
+                 skipped_ticks=0):
+        self.status = status
+        self.tick = tick
+        self.instruction = instruction
+        self.registers = registers
+        self.io = io
+        self.trace_path = trace_path
+        self.error = error
+        self.limit = limit
+        self.pc = pc
+        self.skipped_ticks = skipped_ticks
+
+
+# A single machine, nothing is read or written outside of it unless a path
+# is given. Devices without a sink of their own share sink, by default an
+# in-memory transcript. Setting the cancel event stops the run
+class Emulator:
+    def __init__(self, program, input_data=(), engine='microcode',
+                 memory_model='flat', sink=None, sinks=None, max_ticks=None,
+                 max_instructions=None, cancel=None, max_wall_time=None,
+                 max_stack_depth=None):
+        self.registry = Registry()
+        self.memory = memory_models[memory_model](self.registry)
+        self.memory.load(read_program(program))
+        data_path = DataPath(self.memory, self.registry, None)
 
-    registry = Registry()
-    memory = Memory(registry)
-    memory.load(operation_codes)
-    data_path = DataPath(memory, registry, None)
+        self.sink = sink if sink is not None else ListSink()
+        sinks = sinks or {}
+        self.io_devices = [InputDevice(0, self.registry, self.memory,
+                                       input_data, sinks.get(0, self.sink))]
+        for dev_id, device in enumerate(output_devices, 1):
+            self.io_devices.append(device(dev_id, self.registry, self.memory,
+                                          sinks.get(dev_id, self.sink)))
+
+        self.control_unit = engines[engine](self.registry, self.memory,
+                                            data_path, self.io_devices)
+        self.budget = Budget(max_ticks, max_instructions, cancel,
+                             max_wall_time, max_stack_depth)
+
+    # Triggers may be given as text, labels resolve to program symbols
+    def run(self, trace_level=TraceLevel.OFF, trace_path=None,
+            trace_format=TraceFormat.TEXT, trace_queue=0,
+            trace_overflow=OverflowPolicy.BLOCK, trace_window=1024,
+            trace_post_window=0, trace_triggers=(), frequency=None,
+            fast_forward=False):
+        if trace_path is None:
+            trace_level = TraceLevel.OFF
+        triggers = [parse_trigger(trigger, self.memory.symbols)
+                    if isinstance(trigger, str) else trigger
+                    for trigger in trace_triggers]
+        exceeded = self.control_unit.run(
+            frequency, trace_level, trace_path, trace_format, trace_queue,
+            trace_overflow, trace_window, trace_post_window, triggers,
+            fast_forward, self.budget)
+
+        io = None
+        if isinstance(self.sink, ListSink):
+            io = self.sink.lines
+        if trace_level == TraceLevel.OFF:
+            trace_path = None
+        result = EmulationResult(
+            'halted', self.control_unit.tick, self.control_unit.instruction,
+            dict(vars(self.registry)), io, trace_path,
+            skipped_ticks=self.control_unit.skipped_ticks)
+        if exceeded is not None:
+            result.status = 'limit'
+            if isinstance(exceeded, Cancelled):
+                result.status = 'cancelled'
+            result.error = str(exceeded)
+            result.limit = exceeded.limit
+            result.pc = exceeded.pc
+        return result
+
+
+def main(opcodes, input_queue=None, engine='microcode', memory_model='flat',
+         trace_level=TraceLevel.INSTRUCTION, trace_path='sources.txt',
+         trace_format=TraceFormat.TEXT, trace_queue=0,
+         trace_overflow=OverflowPolicy.BLOCK, trace_window=1024,
+         trace_post_window=0, trace_triggers=(), frequency=None,
+         fast_forward=False, sinks=None, io_path='out.txt', input_path=None,
+         input_chunk=None, max_ticks=None, max_instructions=None,
+         max_wall_time=None, max_stack_depth=None):
+    print('Emulator started...')
 
     input_data = ['Amogus', 'I', 'love', 'CSA', 'Lab3']
 
     if input_queue is not None:
         input_data = input_queue
 
-    io_devices = [
-        InputDevice(0, registry, memory, input_data),
-        StringConsoleOutputDevice(1, registry, memory),
-        IntConsoleOutputDevice(2, registry, memory),
-        UIntConsoleOutputDevice(3, registry, memory),
-        HexConsoleOutputDevice(4, registry, memory),
-        StringFileOutputDevice(5, registry, memory),
-        IntFileOutputDevice(6, registry, memory),
-        UIntFileOutputDevice(7, registry, memory),
-        HexFileOutputDevice(8, registry, memory)
-    ]
+    # A file is read lazily while the program consumes it
+    if input_path is not None:
+        source = open_source(input_path, input_chunk)
+    else:
+        source = Source(input_data)
+
+    with source, open_sink(io_path) as sink:
+        emulator = Emulator(opcodes, source, engine, memory_model, sink,
+                            sinks, max_ticks, max_instructions,
+                            max_wall_time=max_wall_time,
+                            max_stack_depth=max_stack_depth)
+        return emulator.run(trace_level, trace_path, trace_format,
+                            trace_queue, trace_overflow, trace_window,
+                            trace_post_window, trace_triggers, frequency,
+                            fast_forward)
 
-    control_unit = ControlUnit(registry, memory, data_path, io_devices)
 
-    control_unit.run(0)
+def positive_frequency(value):
+    frequency = float(value)
+    if frequency <= 0:
+        raise argparse.ArgumentTypeError(
+            f'clock frequency must be positive: {value}')
+    return frequency
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="CSA Lab 3 emulator")
     parser.add_argument("-o", "--sources", required=True,
-                        type=str, help="File with operation codes")
+                        type=str,
+                        help="File with operation codes or a binary image")
+    parser.add_argument("-i", "--input", default=None,
+                        help="File with input data read line by line, "
+                             "'-' reads stdin")
+    parser.add_argument("--input-chunk", default=None, type=int,
+                        help="Read the input in chunks of this many "
+                             "characters instead of lines")
+    parser.add_argument("-e", "--engine", default='microcode',
+                        choices=engines.keys(),
+                        help="Emulation engine, 'functional' skips microcode "
+                             "but keeps tick accounting")
+    parser.add_argument("-m", "--memory", default='flat',
+                        choices=memory_models.keys(),
+                        help="Memory model, 'paged' allocates pages on "
+                             "first write")
+    parser.add_argument("-t", "--trace", default='instruction',
+                        choices=[level.value for level in TraceLevel],
+                        help="Trace level, 'halt' writes only the final "
+                             "state")
+    parser.add_argument("--trace-file", default='sources.txt',
+                        help="File with the execution trace")
+    parser.add_argument("--trace-format", default='text',
+                        choices=[trace_format.value
+                                 for trace_format in TraceFormat],
+                        help="Trace format, 'binary' stores register deltas")
+    parser.add_argument("--trace-queue", default=0, type=int,
+                        help="Entries queued for the trace writer thread, "
+                             "0 writes the trace synchronously")
+    parser.add_argument("--trace-overflow", default='block',
+                        choices=[policy.value for policy in OverflowPolicy],
+                        help="Action on a full trace queue")
+    parser.add_argument("--trace-window", default=1024, type=int,
+                        help="States kept by the 'flight' trace level")
+    parser.add_argument("--trace-post-window", default=0, type=int,
+                        help="States traced after a trigger fires")
+    parser.add_argument("--trigger", action='append', default=[],
+                        help="Flight trace trigger: pc:ADDR, cell:ADDR or "
+                             "device:ID, ADDR may be a label")
+    parser.add_argument("-f", "--frequency", default=None,
+                        type=positive_frequency,
+                        help="Target clock frequency in ticks per second, "
+                             "unthrottled by default")
+    parser.add_argument("--max-ticks", default=None, type=int,
+                        help="Stop the emulation after this many ticks")
+    parser.add_argument("--max-instructions", default=None, type=int,
+                        help="Stop the emulation after this many "
+                             "instructions")
+    parser.add_argument("--max-wall-time", default=None, type=float,
+                        help="Stop the emulation after this many seconds")
+    parser.add_argument("--max-stack-depth", default=None, type=int,
+                        help="Stop the emulation once the stack grows past "
+                             "this many cells")
+    parser.add_argument("--fast-forward", action='store_true',
+                        help="Skip polling loops waiting for timed input, "
+                             "skipped iterations are not traced")
+    parser.add_argument("--io-file", default='out.txt',
+                        help="File with the transcript of device transfers, "
+                             "'-' writes it to stdout")
     args = parser.parse_args()
-    main(args.opcodes)
+    main(args.sources, engine=args.engine, memory_model=args.memory,
+         trace_level=TraceLevel(args.trace), trace_path=args.trace_file,
+         trace_format=TraceFormat(args.trace_format),
+         trace_queue=args.trace_queue,
+         trace_overflow=OverflowPolicy(args.trace_overflow),
+         trace_window=args.trace_window,
+         trace_post_window=args.trace_post_window,
+         trace_triggers=args.trigger, frequency=args.frequency,
+         fast_forward=args.fast_forward, io_path=args.io_file,
+         input_path=args.input, input_chunk=args.input_chunk,
+         max_ticks=args.max_ticks, max_instructions=args.max_instructions,
+         max_wall_time=args.max_wall_time,
+         max_stack_depth=args.max_stack_depth)
@@ -0,0 +1,155 @@
+from src.emulator.trace import TraceWriter
+
+
+# Fires once PC reaches an address
+class PcTrigger:
+    def __init__(self, address):
+        self.address = address
+
+    def check(self, control_unit):
+        if control_unit.registers.PC & 0xFFFFFF == self.address:
+            return f'PC reached {self.address:06X}'
+        return None
+
+
+# Fires when a memory cell is written, the memory reports the write to it
+# instead of the cell being polled every step
+class CellTrigger:
+    def __init__(self, address):
+        self.address = address
+        self.recorder = None
+
+    def attach(self, memory, recorder):
+        self.recorder = recorder
+        memory.watch(self.address, 1, self.written)
+
+    def detach(self, memory):
+        memory.unwatch(self.address, 1, self.written)
+        self.recorder = None
+
+    def written(self, addr, count):
+        self.recorder.trigger(f'cell {self.address:06X} written')
+
+
+# Fires when the ready bit of a device gets set
+class DeviceReadyTrigger:
+    def __init__(self, dev_id):
+        self.dev_id = dev_id
+        self.ready = True
+
+    def check(self, control_unit):
+        ready = control_unit.memory.cells[self.dev_id * 2] & 0x80000000 != 0
+        was_ready = self.ready
+        self.ready = ready
+        if ready and not was_ready:
+            return f'device {self.dev_id} ready'
+        return None
+
+
+trigger_types = {
+    'pc': PcTrigger,
+    'cell': CellTrigger,
+    'device': DeviceReadyTrigger
+}
+
+
+# Parses 'pc:start', 'pc:0x33', 'cell:0x20' or 'device:1', addresses may be
+# given as labels of the loaded program
+def parse_trigger(text, symbols):
+    kind, _, argument = text.partition(':')
+    if kind not in trigger_types:
+        raise ValueError(f'Unknown trigger: {text}')
+    if argument in symbols:
+        return trigger_types[kind](symbols[argument])
+    try:
+        return trigger_types[kind](int(argument, 0))
+    except ValueError:
+        raise ValueError(f'Invalid trigger argument: {text}')
+
+
+# Keeps the last states in a preallocated ring and writes them out on halt,
+# on an exception or post_trigger states after a trigger fired. Triggers are
+# polled before devices are handled, so ready bits set by the program are
+# still visible. Cell triggers watch the memory while the recorder is
+# attached to it
+class FlightRecorder(TraceWriter):
+    def __init__(self, writer, capacity, post_trigger=0, triggers=()):
+        self.writer = writer
+        self.ring = [None] * capacity
+        self.position = 0
+        self.count = 0
+        self.post_trigger = post_trigger
+        self.triggers = [trigger for trigger in triggers
+                         if not isinstance(trigger, CellTrigger)]
+        self.cell_triggers = [trigger for trigger in triggers
+                              if isinstance(trigger, CellTrigger)]
+        self.memory = None
+        # States left until the pending window is written, -1 without one
+        self.remaining = -1
+        self.reason = None
+
+    def record(self, state):
+        ring = self.ring
+        ring[self.position] = state
+        self.position = (self.position + 1) % len(ring)
+        if self.count < len(ring):
+            self.count += 1
+        if self.remaining > 0:
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.dump(self.reason)
+
+    def write(self, line):
+        pass
+
+    def attach(self, memory):
+        self.memory = memory
+        for trigger in self.cell_triggers:
+            trigger.attach(memory, self)
+
+    def detach(self):
+        if self.memory is None:
+            return
+        for trigger in self.cell_triggers:
+            trigger.detach(self.memory)
+        self.memory = None
+
+    def poll(self, control_unit):
+        for trigger in self.triggers:
+            reason = trigger.check(control_unit)
+            if reason is not None:
+                self.trigger(reason)
+
+    # A trigger is ignored while the window of an earlier one is pending
+    def trigger(self, reason):
+        if self.remaining < 0:
+            self.fire(reason)
+
+    # Triggers are polled before the current state is recorded, the window
+    # includes it
+    def fire(self, reason):
+        self.reason = reason
+        self.remaining = self.post_trigger + 1
+
+    def dump(self, reason):
+        self.remaining = -1
+        if self.count == 0:
+            return
+        self.writer.mark(reason)
+        ring = self.ring
+        start = self.position - self.count
+        for i in range(start, self.position):
+            self.writer.record(ring[i % len(ring)])
+        self.count = 0
+
+    def close(self):
+        self.detach()
+        if self.writer is not None:
+            self.dump(self.reason if self.remaining > 0 else 'halt')
+            self.writer.close()
+            self.writer = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.writer is not None:
+            self.dump(f'{exc_type.__name__}: {exc_value}')
+        self.close()
@@ -0,0 +1,100 @@
+import argparse
+import base64
+import json
+import os
+import socket
+import time
+
+from src.emulator.batch import emulate_job
+from src.emulator.components.sink import ListSink
+from src.emulator.data_path import decode_micro_operation
+from src.emulator.emulator import engines, memory_models
+from src.emulator.microcode import rom, SEQUENCER_WORD
+from src.image import pack_image
+
+# Machine that halts at once, it runs on every engine and memory model
+# before the first fork
+WARM_UP_IMAGE = pack_image({0x40: 0x0A000000}, entry=0x40)
+
+
+# Decodes every data path word of the microcode ROM, so children share the
+# kernels instead of building them again after each fork
+def warm_up():
+    for program in rom.values():
+        for word in program:
+            if word < SEQUENCER_WORD:
+                decode_micro_operation(word)
+    image = base64.b64encode(WARM_UP_IMAGE).decode('ascii')
+    for engine in engines:
+        for memory_model in memory_models:
+            emulate_job({'image': image, 'engine': engine,
+                         'memory_model': memory_model}, ListSink())
+
+
+# Imports and warms up the emulator once, then forks a copy-on-write child
+# per connection. A request is a single JSON line with a batch job, the
+# child answers with a JSON line holding its result and the transcript,
+# and exits
+class ForkServer:
+    def __init__(self, path):
+        self.path = path
+        self.children = set()
+
+    def serve(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            # The socket appears at its path only once it accepts
+            server.bind(self.path + '.tmp')
+            server.listen()
+            os.rename(self.path + '.tmp', self.path)
+            while True:
+                connection, _ = server.accept()
+                self.reap()
+                pid = os.fork()
+                if pid == 0:
+                    server.close()
+                    status = 0
+                    try:
+                        self.handle(connection)
+                    except Exception:
+                        status = 1
+                    os._exit(status)
+                self.children.add(pid)
+                connection.close()
+
+    # Collects finished children without blocking
+    def reap(self):
+        for pid in list(self.children):
+            if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                self.children.discard(pid)
+
+    def handle(self, connection):
+        with connection, connection.makefile('rwb') as stream:
+            job = json.loads(stream.readline())
+            sink = ListSink()
+            result = emulate_job(job, sink, job.get('trace_path'))
+            result['io'] = sink.lines
+            stream.write(json.dumps(result).encode('utf-8') + b'\n')
+
+
+# Sends a job to a fork server and waits for its result
+def submit(path, job):
+    started = time.monotonic()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        with client.makefile('rwb') as stream:
+            stream.write(json.dumps(job).encode('utf-8') + b'\n')
+            stream.flush()
+            result = json.loads(stream.readline())
+    result['latency'] = round(time.monotonic() - started, 6)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CSA Lab 3 fork server")
+    parser.add_argument("-s", "--socket", required=True, type=str,
+                        help="Unix socket path to listen on")
+    args = parser.parse_args()
+    warm_up()
+    ForkServer(args.socket).serve()
@@ -0,0 +1,497 @@
+from src.emulator.components.memory import PAGE_BITS
+from src.emulator.control_unit import ControlUnit, dispatch_table, \
+    non_address_commands, address_commands, instruction_microprograms, \
+    arbitrary_stores
+from src.emulator.data_path import decode_micro_operation
+from src.emulator.mc_mnemonic_parser import parse_mnemonic
+from src.emulator.microcode import rom, microprogram_ticks
+
+WORD_MASK = 0xFFFFFFFF
+ADDR_MASK = 0xFFFFFF
+
+
+# ALU and commutator kernels of a single microcode step
+def _step(mnemonic):
+    micro_operation = decode_micro_operation(parse_mnemonic(mnemonic))
+    return micro_operation.alu, micro_operation.commutator
+
+
+add_alu, add_commutator = _step('BR + DR -> DR {NZVC}')
+sub_alu, sub_commutator = _step('BR + ~DR+1 -> DR {NZVC}')
+mul_alu, mul_commutator = _step('BR * DR -> DR {NZVC}')
+div_alu, div_commutator = _step('BR / DR -> DR {NZVC}')
+and_alu, and_commutator = _step('BR & DR -> DR {NZ}')
+nor_alu, nor_commutator = _step('~BR & ~DR -> DR')
+not_alu, not_commutator = _step('~DR -> DR {NZ}')
+neg_alu, neg_commutator = _step('~DR+1 -> DR {NZ}')
+shl_alu, shl_commutator = _step('SHL(DR) -> DR')
+shr_alu, shr_commutator = _step('SHR(DR) -> DR')
+rol_alu, rol_commutator = _step('ROL(DR) -> DR')
+ror_alu, ror_commutator = _step('ROR(DR) -> DR')
+cmp_alu, cmp_commutator = _step('BR + ~DR+1 -> BR {NZVC}')
+
+
+# Every handler leaves registers and memory exactly as the microprogram of
+# the instruction does. Conditional jumps return False when not taken.
+
+def exec_nop(r, m):
+    pass
+
+
+def exec_pop(r, m):
+    r.SP = (r.SP + 1) & WORD_MASK
+
+
+def exec_pushf(r, m):
+    sp = (r.SP - 1) & WORD_MASK
+    r.SP = r.AR = sp
+    r.DR = r.SR & WORD_MASK
+    m[sp & ADDR_MASK] = r.DR
+
+
+def exec_popf(r, m):
+    sp = r.SP
+    r.AR = sp
+    r.DR = r.SR = m[sp & ADDR_MASK]
+    r.SP = (sp + 1) & WORD_MASK
+
+
+def exec_inc(r, m):
+    sp = r.SP
+    r.AR = sp
+    r.DR = m[sp & ADDR_MASK] = (m[sp & ADDR_MASK] + 1) & WORD_MASK
+
+
+def exec_dec(r, m):
+    sp = r.SP
+    r.AR = sp
+    r.DR = m[sp & ADDR_MASK] = (m[sp & ADDR_MASK] - 1) & WORD_MASK
+
+
+def exec_swap(r, m):
+    sp = r.SP
+    nos_addr = (sp + 1) & WORD_MASK
+    tos = m[sp & ADDR_MASK]
+    m[sp & ADDR_MASK] = m[nos_addr & ADDR_MASK]
+    m[nos_addr & ADDR_MASK] = tos
+    r.AR = nos_addr
+    r.DR = r.BR = tos
+
+
+def exec_dup(r, m):
+    value = m[r.SP & ADDR_MASK]
+    sp = (r.SP - 1) & WORD_MASK
+    r.SP = r.AR = sp
+    r.DR = m[sp & ADDR_MASK] = value
+
+
+def exec_ret(r, m):
+    sp = r.SP
+    r.AR = sp
+    r.DR = r.PC = m[sp & ADDR_MASK]
+    r.SP = (sp + 1) & WORD_MASK
+
+
+def exec_iret(r, m):
+    exec_popf(r, m)
+    exec_ret(r, m)
+
+
+def exec_halt(r, m):
+    r.SR &= 0x7FFF
+
+
+def exec_ei(r, m):
+    r.SR |= 0x4000
+
+
+def exec_di(r, m):
+    r.SR &= 0xBFFF
+
+
+# Interrupt entry, CR holds the vector cell of the device
+def exec_interrupt(r, m):
+    sp = (r.SP - 1) & WORD_MASK
+    m[sp & ADDR_MASK] = r.PC
+    sp = (sp - 1) & WORD_MASK
+    r.SP = r.AR = sp
+    r.DR = m[sp & ADDR_MASK] = r.SR
+    r.PC = r.CR & ADDR_MASK
+    r.SR &= 0xBFFF
+
+
+def gen_exec_binary(alu, commutator):
+    def exec_binary(r, m):
+        sp = r.SP
+        tos = m[sp & ADDR_MASK]
+        sp = (sp + 1) & WORD_MASK
+        res, flags = alu(tos, m[sp & ADDR_MASK])
+        res = commutator(res, flags, r)
+        r.AR = r.SP = sp
+        r.BR = tos
+        r.DR = m[sp & ADDR_MASK] = res
+
+    return exec_binary
+
+
+exec_add = gen_exec_binary(add_alu, add_commutator)
+exec_sub = gen_exec_binary(sub_alu, sub_commutator)
+exec_mul = gen_exec_binary(mul_alu, mul_commutator)
+exec_div = gen_exec_binary(div_alu, div_commutator)
+exec_and = gen_exec_binary(and_alu, and_commutator)
+
+
+def exec_or(r, m):
+    sp = r.SP
+    tos = m[sp & ADDR_MASK]
+    sp = (sp + 1) & WORD_MASK
+    res, flags = nor_alu(tos, m[sp & ADDR_MASK])
+    res = nor_commutator(res, flags, r)
+    res, flags = not_alu(res, 0)
+    res = not_commutator(res, flags, r)
+    r.AR = r.SP = sp
+    r.BR = tos
+    r.DR = m[sp & ADDR_MASK] = res
+
+
+def gen_exec_unary(alu, commutator):
+    def exec_unary(r, m):
+        sp = r.SP
+        res, flags = alu(m[sp & ADDR_MASK], 0)
+        res = commutator(res, flags, r)
+        r.AR = sp
+        r.DR = m[sp & ADDR_MASK] = res
+
+    return exec_unary
+
+
+exec_not = gen_exec_unary(not_alu, not_commutator)
+exec_neg = gen_exec_unary(neg_alu, neg_commutator)
+exec_shl = gen_exec_unary(shl_alu, shl_commutator)
+exec_shr = gen_exec_unary(shr_alu, shr_commutator)
+exec_rol = gen_exec_unary(rol_alu, rol_commutator)
+exec_ror = gen_exec_unary(ror_alu, ror_commutator)
+
+
+def exec_cmp(r, m):
+    sp = r.SP
+    tos = m[sp & ADDR_MASK]
+    nos_addr = (sp + 1) & WORD_MASK
+    nos = m[nos_addr & ADDR_MASK]
+    res, flags = cmp_alu(tos, nos)
+    r.BR = cmp_commutator(res, flags, r)
+    r.AR = nos_addr
+    r.DR = m[nos_addr & ADDR_MASK] = nos
+
+
+def exec_ld(r, m):
+    sp = r.SP
+    value = m[m[sp & ADDR_MASK] & ADDR_MASK]
+    sp = (sp - 1) & WORD_MASK
+    r.AR = r.SP = sp
+    r.DR = m[sp & ADDR_MASK] = value
+
+
+def exec_st(r, m):
+    sp = r.SP
+    addr = m[(sp + 1) & ADDR_MASK]
+    value = m[sp & ADDR_MASK]
+    r.SP = (sp + 1) & WORD_MASK
+    r.AR = r.BR = addr
+    r.DR = m[addr & ADDR_MASK] = value
+
+
+def exec_push(r, m):
+    sp = (r.SP - 1) & WORD_MASK
+    r.SP = r.AR = sp
+    r.DR = m[sp & ADDR_MASK] = r.CR & ADDR_MASK
+
+
+def exec_jmp(r, m):
+    r.PC = r.CR & ADDR_MASK
+
+
+def exec_jz(r, m):
+    if r.SR & 0x4 == 0:
+        return False
+    r.PC = r.CR & ADDR_MASK
+
+
+def exec_jnz(r, m):
+    if r.SR & 0x4 != 0:
+        return False
+    r.PC = r.CR & ADDR_MASK
+
+
+def exec_jg(r, m):
+    if r.SR & 0x8 != 0:
+        return False
+    r.PC = r.CR & ADDR_MASK
+
+
+def exec_jge(r, m):
+    if r.SR & 0xC == 0x8:
+        return False
+    r.PC = r.CR & ADDR_MASK
+
+
+def exec_jl(r, m):
+    if r.SR & 0x8 == 0:
+        return False
+    r.PC = r.CR & ADDR_MASK
+
+
+def exec_jle(r, m):
+    if r.SR & 0xC == 0:
+        return False
+    r.PC = r.CR & ADDR_MASK
+
+
+def exec_call(r, m):
+    sp = (r.SP - 1) & WORD_MASK
+    r.SP = r.AR = sp
+    r.DR = m[sp & ADDR_MASK] = r.PC
+    r.PC = r.CR & ADDR_MASK
+
+
+# Ready bit mask pushed by set/unset/check ('1' rotated right)
+ready_mask = ror_commutator(*ror_alu(1, 0), None)
+
+
+# Common prefix of set/unset/check: push, ld and the ready bit mask
+def push_device_status(r, m):
+    sp = r.SP
+    device_addr = (sp - 1) & WORD_MASK
+    status_addr = (sp - 2) & WORD_MASK
+    mask_addr = (sp - 3) & WORD_MASK
+    m[device_addr & ADDR_MASK] = r.CR & ADDR_MASK
+    m[status_addr & ADDR_MASK] = m[m[device_addr & ADDR_MASK] & ADDR_MASK]
+    m[mask_addr & ADDR_MASK] = ready_mask
+    return device_addr, status_addr, mask_addr
+
+
+# Tail of set/unset: st of the new status and pop
+def store_device_status(r, m, device_addr, status_addr):
+    addr = m[device_addr & ADDR_MASK]
+    value = m[status_addr & ADDR_MASK]
+    r.AR = r.BR = addr
+    r.DR = m[addr & ADDR_MASK] = value
+
+
+def exec_set(r, m):
+    device_addr, status_addr, mask_addr = push_device_status(r, m)
+    res, flags = nor_alu(m[mask_addr & ADDR_MASK],
+                         m[status_addr & ADDR_MASK])
+    res = nor_commutator(res, flags, r)
+    res, flags = not_alu(res, 0)
+    m[status_addr & ADDR_MASK] = not_commutator(res, flags, r)
+    store_device_status(r, m, device_addr, status_addr)
+
+
+def exec_unset(r, m):
+    device_addr, status_addr, mask_addr = push_device_status(r, m)
+    res, flags = not_alu(m[mask_addr & ADDR_MASK], 0)
+    m[mask_addr & ADDR_MASK] = not_commutator(res, flags, r)
+    res, flags = and_alu(m[mask_addr & ADDR_MASK],
+                         m[status_addr & ADDR_MASK])
+    m[status_addr & ADDR_MASK] = and_commutator(res, flags, r)
+    store_device_status(r, m, device_addr, status_addr)
+
+
+def exec_check(r, m):
+    device_addr, status_addr, mask_addr = push_device_status(r, m)
+    mask = m[mask_addr & ADDR_MASK]
+    res, flags = and_alu(mask, m[status_addr & ADDR_MASK])
+    r.AR = status_addr
+    r.BR = mask
+    r.DR = m[status_addr & ADDR_MASK] = and_commutator(res, flags, r)
+
+
+instruction_handlers = {
+    'nop': exec_nop,
+    'pop': exec_pop,
+    'pushf': exec_pushf,
+    'popf': exec_popf,
+    'inc': exec_inc,
+    'dec': exec_dec,
+    'swap': exec_swap,
+    'dup': exec_dup,
+    'ret': exec_ret,
+    'halt': exec_halt,
+    'iret': exec_iret,
+    'ei': exec_ei,
+    'di': exec_di,
+    'add': exec_add,
+    'sub': exec_sub,
+    'mul': exec_mul,
+    'div': exec_div,
+    'and': exec_and,
+    'or': exec_or,
+    'not': exec_not,
+    'neg': exec_neg,
+    'shl': exec_shl,
+    'shr': exec_shr,
+    'rol': exec_rol,
+    'ror': exec_ror,
+    'cmp': exec_cmp,
+    'ld': exec_ld,
+    'st': exec_st,
+    'jmp': exec_jmp,
+    'jz': exec_jz,
+    'je': exec_jz,
+    'jnz': exec_jnz,
+    'jg': exec_jg,
+    'jge': exec_jge,
+    'jl': exec_jl,
+    'jle': exec_jle,
+    'call': exec_call,
+    'push': exec_push,
+    'set': exec_set,
+    'unset': exec_unset,
+    'check': exec_check,
+}
+
+
+# Stack cells written by an instruction relative to SP and its SP change
+stack_effects = {
+    'push': ((-1,), -1),
+    'pop': ((), 1),
+    'pushf': ((-1,), -1),
+    'popf': ((), 1),
+    'inc': ((0,), 0),
+    'dec': ((0,), 0),
+    'swap': ((0, 1), 0),
+    'dup': ((-1,), -1),
+    'ret': ((), 1),
+    'iret': ((), 2),
+    'add': ((1,), 1),
+    'sub': ((1,), 1),
+    'mul': ((1,), 1),
+    'div': ((1,), 1),
+    'and': ((1,), 1),
+    'or': ((1,), 1),
+    'not': ((0,), 0),
+    'neg': ((0,), 0),
+    'shl': ((0,), 0),
+    'shr': ((0,), 0),
+    'rol': ((0,), 0),
+    'ror': ((0,), 0),
+    'cmp': ((1,), 0),
+    'ld': ((-1,), -1),
+    'st': ((), 1),
+    'call': ((-1,), -1),
+    'set': ((-1, -2, -3), 0),
+    'unset': ((-1, -2, -3), 0),
+    'check': ((-1, -2, -3), 0),
+}
+
+
+# Handler, tick costs (taken, not taken), whether it stores to an arbitrary
+# cell and the range of stack cells it writes (offset from SP and count) for
+# every opcode byte
+def build_handler_table():
+    table = [None] * 0x100
+    opcodes = list(non_address_commands.items())
+    for opcode, instruction in address_commands.items():
+        opcodes += [(opcode | mode, instruction) for mode in range(4)]
+    for opcode, instruction in opcodes:
+        name = instruction_microprograms[instruction]
+        writes, _ = stack_effects.get(name, ((), 0))
+        low = min(writes, default=0)
+        table[opcode] = (instruction_handlers[name],
+                         microprogram_ticks(dispatch_table[opcode]),
+                         microprogram_ticks(dispatch_table[opcode], False),
+                         name in arbitrary_stores,
+                         low, max(writes, default=low - 1) - low + 1)
+    return table
+
+
+handler_table = build_handler_table()
+fetch_ticks = microprogram_ticks(rom['fetch'])
+interrupt_ticks = microprogram_ticks(rom['interrupt'])
+
+
+def exec_invalid(r, m):
+    raise ValueError(f'Invalid opcode: {r.CR >> 24:02X}')
+
+
+# Handler table of the execution loop, the fetch is included in the tick
+# costs and invalid opcodes have a handler raising an error
+step_table = [(exec_invalid, 0, 0, False, 0, 0) if entry is None
+              else (entry[0], fetch_ticks + entry[1], fetch_ticks + entry[2])
+              + entry[3:] for entry in handler_table]
+
+
+# Executes every instruction as a single Python operation instead of
+# microcode, ticks are accounted from the microprograms
+class FunctionalControlUnit(ControlUnit):
+    def process(self):
+        FunctionalControlUnit.run_until(self, self.tick + 1)
+
+    # Runs instructions in a single frame with the counters in locals, they
+    # are stored back before devices and interrupts are handled. Interrupt
+    # requests are only raised by devices
+    def run_until(self, end_tick):
+        table = step_table
+        registers = self.registers
+        memory = self.memory
+        cells = memory.cells
+        watches = memory.watches
+        pending_devices = self.pending_devices
+        interrupt_controller = self.interrupt_controller
+        # Flight recorder triggers are polled with the devices every step
+        polling = self.poll_triggers is not None
+        device_event = -1 if polling else self.next_device_event
+        interrupts = interrupt_controller.pending
+        tick = self.tick
+        instruction = self.instruction
+        try:
+            while registers.SR & 0x8000 and tick < end_tick:
+                pc = registers.PC
+                registers.AR = registers.BR = pc
+                registers.DR = registers.CR = cr = cells[pc & 0xFFFFFF]
+                registers.PC = (pc + 1) & 0xFFFFFFFF
+
+                handler, ticks, not_taken_ticks, stores, low, count = \
+                    table[cr >> 24]
+                sp = registers.SP
+                if handler(registers, cells) is False:
+                    tick += not_taken_ticks
+                else:
+                    tick += ticks
+                # Writes are reported only when they reach watched cells
+                if stores:
+                    addr = registers.AR & 0xFFFFFF
+                    if addr >> PAGE_BITS in watches:
+                        memory.written(addr)
+                if count:
+                    addr = (sp + low) & 0xFFFFFF
+                    if (addr >> PAGE_BITS in watches
+                            or count > 1
+                            and ((addr + count - 1) & 0xFFFFFF) >> PAGE_BITS
+                            in watches):
+                        memory.written(addr, count)
+
+                if pending_devices or tick >= device_event:
+                    self.tick = tick
+                    self.handle_devices()
+                    if not polling:
+                        device_event = self.next_device_event
+                    interrupts = interrupt_controller.pending
+                instruction += 1
+                if interrupts and registers.SR & 0xC000 == 0xC000:
+                    self.tick = tick
+                    self.enter_interrupt()
+                    tick = self.tick
+                    interrupts = interrupt_controller.pending
+        finally:
+            self.tick = tick
+            self.instruction = instruction
+
+    def enter_interrupt(self):
+        dev_id = self.interrupt_controller.acknowledge()
+        self.registers.CR = self.memory.cells[dev_id * 2]
+        sp = self.registers.SP
+        exec_interrupt(self.registers, self.memory.cells)
+        self.memory.written((sp - 2) & ADDR_MASK, 2)
+        self.tick += interrupt_ticks
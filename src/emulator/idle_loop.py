@@ -0,0 +1,89 @@
+import math
+
+ADDR_MASK = 0xFFFFFF
+# Cells on both sides of SP compared between iterations, a block writes at
+# most its length and three cells below the SP it was entered with
+SCRATCH_CELLS = 128
+# Largest SP movement between steps of an iteration inside the window
+MAX_STACK_DEPTH = 32
+
+
+# Skips the iterations of a polling loop before the next scheduled device
+# event. Two iterations starting at the same backward jump target are
+# compared: equal registers and stack cells, equal stores and no device
+# transfers mean the second one ended in the state it started from, so the
+# loop repeats until a device wakes up. Whole iterations are then added to
+# the counters at once
+class IdleLoopDetector:
+    def __init__(self, control_unit, store_opcodes, step):
+        self.control_unit = control_unit
+        self.step = step
+        self.store_opcodes = store_opcodes
+        self.skipped_ticks = 0
+        self.visits = []
+        self.restart()
+
+    def restart(self):
+        self.stores = []
+        self.low_sp = self.high_sp = self.control_unit.registers.SP
+
+    def window(self, sp):
+        cells = self.control_unit.memory.cells
+        return [cells[(sp + offset) & ADDR_MASK]
+                for offset in range(-SCRATCH_CELLS, SCRATCH_CELLS)]
+
+    def process(self):
+        registers = self.control_unit.registers
+        pc = registers.PC
+        self.step()
+        # Stores end an instruction step and a block, CR still holds them
+        if registers.CR >> 24 in self.store_opcodes:
+            self.stores.append((registers.AR & ADDR_MASK, registers.DR))
+        sp = registers.SP
+        if sp < self.low_sp:
+            self.low_sp = sp
+        elif sp > self.high_sp:
+            self.high_sp = sp
+        if registers.PC <= pc:
+            self.visit(registers.PC)
+
+    def visit(self, pc):
+        control_unit = self.control_unit
+        # Nothing is scheduled, the loop never ends and is not compared
+        if control_unit.next_device_event == math.inf:
+            self.visits = []
+            self.restart()
+            return
+
+        registers = control_unit.registers
+        sp = registers.SP
+        key = (pc, tuple(vars(registers).values()),
+               control_unit.interrupt_controller.pending,
+               control_unit.device_activity)
+        if (not self.visits or self.visits[-1][0] != key
+                or sp - self.low_sp > MAX_STACK_DEPTH
+                or self.high_sp - sp > MAX_STACK_DEPTH):
+            self.visits = [(key, control_unit.tick, control_unit.instruction,
+                            None, None)]
+            self.restart()
+            return
+
+        visit = (key, control_unit.tick, control_unit.instruction,
+                 self.stores, self.window(sp))
+        previous = self.visits[-1]
+        self.visits = [previous, visit]
+        self.restart()
+        if previous[3] is None or previous[3:] != visit[3:]:
+            return
+
+        ticks = visit[1] - previous[1]
+        instructions = visit[2] - previous[2]
+        # Every skipped iteration must end before the event
+        iterations = (control_unit.next_device_event - 1
+                      - control_unit.tick) // ticks
+        if iterations < 1:
+            return
+        control_unit.tick += iterations * ticks
+        control_unit.instruction += iterations * instructions
+        self.skipped_ticks += iterations * ticks
+        self.visits = []
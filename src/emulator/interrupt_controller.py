@@ -0,0 +1,14 @@
+# Device number of every pending interrupt request is a bit of a single
+# integer, the lowest device number is served first
+class InterruptController:
+    def __init__(self):
+        self.pending = 0
+
+    def raise_interrupt(self, dev_id):
+        self.pending |= 1 << dev_id
+
+    def acknowledge(self):
+        pending = self.pending
+        dev_id = (pending & -pending).bit_length() - 1
+        self.pending = pending & (pending - 1)
+        return dev_id
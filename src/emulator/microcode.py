@@ -0,0 +1,324 @@
+from enum import Enum
+
+from src.emulator.mc_mnemonic_parser import parse_mnemonic
+
+
+class SequencerOperations(Enum):
+    NONE = 0b00
+    BRANCH = 0b01
+    SET_SR = 0b10
+    RESET_SR = 0b11
+
+
+# Data path words occupy the lower 40 bits of a microcode word, the sequencer
+# operation is stored above them
+SEQUENCER_SHIFT = 40
+SEQUENCER_WORD = 1 << SEQUENCER_SHIFT
+
+
+def gen_seq(operation, data):
+    return operation.value << SEQUENCER_SHIFT | data
+
+
+# Ends the microprogram without spending a tick unless
+# (SR & mask == value) != negate
+def gen_branch(mask, value, negate=False):
+    return gen_seq(SequencerOperations.BRANCH,
+                   int(negate) << 8 | mask << 4 | value)
+
+
+# Sets or resets SR bits in a single tick
+def gen_set_sr(bits):
+    return gen_seq(SequencerOperations.SET_SR, bits)
+
+
+# Resetting also drops the bits above the 16-bit register
+def gen_reset_sr(bits):
+    return gen_seq(SequencerOperations.RESET_SR, bits)
+
+
+# Microprograms of the control unit, every mnemonic takes exactly one tick
+microprograms = {
+    'nop': (),
+    'halt': (
+        gen_reset_sr(0x8000),
+    ),
+    'ei': (
+        gen_set_sr(0x4000),
+    ),
+    'di': (
+        gen_reset_sr(0x4000),
+    ),
+    'fetch': (
+        'PC -> AR, BR',
+        'MEM(AR) -> DR',
+        'DR -> CR',
+        'BR + 1 -> PC',
+    ),
+    'pop': (
+        'SP + 1 -> SP',
+    ),
+    'pushf': (
+        'SP + ~0 -> SP, AR',
+        'SR -> DR',
+        'DR -> MEM(AR)',
+    ),
+    'popf': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR -> SR',
+        'SP + 1 -> SP',
+    ),
+    'inc': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR + 1 -> DR',
+        'DR -> MEM(AR)',
+    ),
+    'dec': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR + ~0 -> DR',
+        'DR -> MEM(AR)',
+    ),
+    'swap': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR -> BR',
+        'SP + 1 -> AR',
+        'MEM(AR) -> DR',
+        'SP -> AR',
+        'DR -> MEM(AR)',
+        'BR -> DR',
+        'SP + 1 -> AR',
+        'DR -> MEM(AR)',
+    ),
+    'dup': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'SP + ~0 -> SP, AR',
+        'DR -> MEM(AR)',
+    ),
+    'ret': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR -> PC',
+        'SP + 1 -> SP',
+    ),
+    'add': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR -> BR',
+        'SP + 1 -> AR, SP',
+        'MEM(AR) -> DR',
+        'BR + DR -> DR {NZVC}',
+        'DR -> MEM(AR)',
+    ),
+    'sub': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR -> BR',
+        'SP + 1 -> AR, SP',
+        'MEM(AR) -> DR',
+        'BR + ~DR+1 -> DR {NZVC}',
+        'DR -> MEM(AR)',
+    ),
+    'mul': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR -> BR',
+        'SP + 1 -> AR, SP',
+        'MEM(AR) -> DR',
+        'BR * DR -> DR {NZVC}',
+        'DR -> MEM(AR)',
+    ),
+    'div': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR -> BR',
+        'SP + 1 -> AR, SP',
+        'MEM(AR) -> DR',
+        'BR / DR -> DR {NZVC}',
+        'DR -> MEM(AR)',
+    ),
+    'and': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR -> BR',
+        'SP + 1 -> AR, SP',
+        'MEM(AR) -> DR',
+        'BR & DR -> DR {NZ}',
+        'DR -> MEM(AR)',
+    ),
+    'or': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR -> BR',
+        'SP + 1 -> AR, SP',
+        'MEM(AR) -> DR',
+        '~BR & ~DR -> DR',
+        '~DR -> DR {NZ}',
+        'DR -> MEM(AR)',
+    ),
+    'not': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        '~DR -> DR {NZ}',
+        'DR -> MEM(AR)',
+    ),
+    'neg': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        '~DR+1 -> DR {NZ}',
+        'DR -> MEM(AR)',
+    ),
+    'shl': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'SHL(DR) -> DR',
+        'DR -> MEM(AR)',
+    ),
+    'shr': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'SHR(DR) -> DR',
+        'DR -> MEM(AR)',
+    ),
+    'rol': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'ROL(DR) -> DR',
+        'DR -> MEM(AR)',
+    ),
+    'ror': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'ROR(DR) -> DR',
+        'DR -> MEM(AR)',
+    ),
+    'cmp': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR -> BR',
+        'SP + 1 -> AR',
+        'MEM(AR) -> DR',
+        'BR + ~DR+1 -> BR {NZVC}',
+        'DR -> MEM(AR)',
+    ),
+    'ld': (
+        'SP -> AR',
+        'MEM(AR) -> DR',
+        'DR -> AR',
+        'MEM(AR) -> DR',
+        'SP + ~0 -> AR, SP',
+        'DR -> MEM(AR)',
+    ),
+    'st': (
+        'SP + 1 -> AR, SP',
+        'MEM(AR) -> DR',
+        'DR -> BR',
+        'SP + ~0 -> AR',
+        'MEM(AR) -> DR',
+        'BR -> AR',
+        'DR -> MEM(AR)',
+    ),
+    'push': (
+        'CUTB(CR) -> DR',
+        'SP + ~0 -> SP, AR',
+        'DR -> MEM(AR)',
+    ),
+    'jmp': (
+        'CUTB(CR) -> PC',
+    ),
+    'jz': (
+        gen_branch(0b0100, 0b0100),
+        'CUTB(CR) -> PC',
+    ),
+    'jnz': (
+        gen_branch(0b0100, 0b0000),
+        'CUTB(CR) -> PC',
+    ),
+    'jg': (
+        gen_branch(0b1000, 0b0000),
+        'CUTB(CR) -> PC',
+    ),
+    'jge': (
+        gen_branch(0b1100, 0b1000, negate=True),
+        'CUTB(CR) -> PC',
+    ),
+    'jl': (
+        gen_branch(0b1000, 0b1000),
+        'CUTB(CR) -> PC',
+    ),
+    'jle': (
+        gen_branch(0b1100, 0b0000, negate=True),
+        'CUTB(CR) -> PC',
+    ),
+    'call': (
+        'SP + ~0 -> SP, AR',
+        'PC -> DR',
+        'DR -> MEM(AR)',
+        'CUTB(CR) -> PC',
+    ),
+    # Interrupt entry, CR holds the vector cell of the device. IRET pops
+    # the flags and then the return address
+    'interrupt': (
+        'SP + ~0 -> SP, AR',
+        'PC -> DR',
+        'DR -> MEM(AR)',
+        'SP + ~0 -> SP, AR',
+        'SR -> DR',
+        'DR -> MEM(AR)',
+        'CUTB(CR) -> PC',
+        gen_reset_sr(0x4000),
+    ),
+    # Pushes the ready bit mask (1 before rotation) used by set/unset/check
+    'push_one': (
+        'SP + ~0 -> SP, AR',
+        'BR & ~BR -> BR',
+        'BR + 1 -> DR',
+        'DR -> MEM(AR)',
+    ),
+}
+
+
+microprograms['je'] = microprograms['jz']
+microprograms['iret'] = microprograms['popf'] + microprograms['ret']
+
+# Device instructions are flattened from the stack microprograms
+microprograms['set'] = (
+        microprograms['push'] + microprograms['ld']
+        + microprograms['push_one'] + microprograms['ror']
+        + microprograms['or'] + microprograms['st'] + microprograms['pop'])
+microprograms['unset'] = (
+        microprograms['push'] + microprograms['ld']
+        + microprograms['push_one'] + microprograms['ror']
+        + microprograms['not'] + microprograms['and']
+        + microprograms['st'] + microprograms['pop'])
+microprograms['check'] = (
+        microprograms['push'] + microprograms['ld']
+        + microprograms['push_one'] + microprograms['ror']
+        + microprograms['and'] + microprograms['pop'] + microprograms['pop'])
+
+
+def compile_microprogram(microprogram):
+    return tuple(parse_mnemonic(step) if isinstance(step, str) else step
+                 for step in microprogram)
+
+
+# Microcode ROM, each microprogram is compiled into data path words only once
+rom = {name: compile_microprogram(program)
+       for name, program in microprograms.items()}
+
+
+# Ticks spent by a microprogram, a branch word ends it when not taken
+def microprogram_ticks(program, branch_taken=True):
+    ticks = 0
+    for word in program:
+        operation = word >> SEQUENCER_SHIFT
+        if operation == SequencerOperations.BRANCH.value:
+            if not branch_taken:
+                return ticks
+            continue
+        ticks += 1
+    return ticks
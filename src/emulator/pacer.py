@@ -0,0 +1,41 @@
+import time
+
+# Pacing checks per second of emulated time
+PACING_RATE = 100
+# Lag after which the schedule is restarted instead of catching up
+MAX_LAG = 1.0
+
+
+# Keeps emulation at a target clock frequency in ticks per second. The
+# control unit runs until the tick returned by pace() and then sleeps only
+# for the time it is ahead of the monotonic clock
+class Pacer:
+    def __init__(self, frequency=None):
+        if frequency is not None and frequency <= 0:
+            raise ValueError(f'Clock frequency must be positive: {frequency}')
+        self.frequency = frequency
+        self.batch_ticks = 0
+        if frequency is not None:
+            self.batch_ticks = max(1, int(frequency // PACING_RATE))
+        self.origin = 0
+        self.origin_tick = 0
+
+    # Returns the tick of the first check, never reached when unthrottled
+    def start(self, tick):
+        if self.frequency is None:
+            return float('inf')
+        self.origin = time.monotonic()
+        self.origin_tick = tick
+        return tick + self.batch_ticks
+
+    def pace(self, tick):
+        if self.frequency is None:
+            return float('inf')
+        target = self.origin + (tick - self.origin_tick) / self.frequency
+        delay = target - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        elif delay < -MAX_LAG:
+            self.origin = time.monotonic()
+            self.origin_tick = tick
+        return tick + self.batch_ticks
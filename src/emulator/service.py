@@ -0,0 +1,155 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from src.emulator.batch import emulate_job
+from src.emulator.components.sink import CallbackSink
+
+
+# Runs in a pool process, device output is sent line by line and None marks
+# the end of the job
+def run_streaming_job(job, output, cancel):
+    try:
+        return emulate_job(job, CallbackSink(output.put), cancel=cancel)
+    finally:
+        output.put(None)
+
+
+# Batch job keys naming files of the server, clients send their data
+SERVER_PATH_KEYS = ('program', 'input_path')
+
+
+# Local job service speaking JSON lines. A client sends a batch job (with
+# 'assembly' or 'image' and its 'input'), receives {"event": "output"} lines
+# while the program runs and a final {"event": "result"} line. Sending
+# {"op": "cancel"} or closing the connection cancels the job. At most
+# max_jobs jobs run at once on a pool of worker processes, the others
+# wait, and job budgets are capped by the service limits
+class JobService:
+    def __init__(self, workers=None, max_jobs=None, max_ticks=None,
+                 max_instructions=None, max_wall_time=None):
+        self.workers = workers or multiprocessing.cpu_count()
+        self.max_jobs = max_jobs or self.workers
+        self.max_ticks = max_ticks
+        self.max_instructions = max_instructions
+        self.max_wall_time = max_wall_time
+        self.slots = None
+        self.manager = None
+        self.executor = None
+        # Threads waiting for the output of running jobs
+        self.readers = None
+
+    def __enter__(self):
+        self.slots = asyncio.Semaphore(self.max_jobs)
+        self.manager = multiprocessing.Manager()
+        # Workers forked from the service would inherit client sockets and
+        # keep them open, the fork server starts them with the emulator
+        # already imported
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['src.emulator.batch'])
+        self.executor = ProcessPoolExecutor(self.workers, context)
+        self.readers = ThreadPoolExecutor(self.max_jobs)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.executor.shutdown(cancel_futures=True)
+        self.readers.shutdown()
+        self.manager.shutdown()
+
+    def capped(self, job):
+        if not isinstance(job, dict):
+            raise ValueError('A job must be a JSON object')
+        for key in SERVER_PATH_KEYS:
+            if key in job:
+                raise ValueError(f'Job key is not accepted: {key}')
+        job = dict(job)
+        for key in ('max_ticks', 'max_instructions', 'max_wall_time'):
+            limit = getattr(self, key)
+            if limit is not None:
+                job[key] = min(job.get(key) or limit, limit)
+        return job
+
+    async def send(self, writer, message):
+        writer.write(json.dumps(message).encode('utf-8') + b'\n')
+        await writer.drain()
+
+    async def watch(self, reader, cancel):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(message, dict) and message.get('op') == 'cancel':
+                break
+        cancel.set()
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        try:
+            job = self.capped(json.loads(await reader.readline()))
+        except (TypeError, ValueError) as error:
+            await self.send(writer, {'event': 'result', 'status': 'error',
+                                     'error': str(error)})
+            writer.close()
+            return
+
+        async with self.slots:
+            output = self.manager.Queue()
+            cancel = self.manager.Event()
+            watcher = asyncio.create_task(self.watch(reader, cancel))
+            future = loop.run_in_executor(self.executor, run_streaming_job,
+                                          job, output, cancel)
+            try:
+                while True:
+                    line = await loop.run_in_executor(self.readers,
+                                                      output.get)
+                    if line is None:
+                        break
+                    await self.send(writer, {'event': 'output',
+                                             'line': line})
+                result = await future
+                await self.send(writer, dict(event='result', **result))
+            except ConnectionError:
+                cancel.set()
+                await future
+            finally:
+                watcher.cancel()
+                writer.close()
+
+    async def serve(self, path=None, port=None):
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, 'localhost',
+                                                port)
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CSA Lab 3 job service")
+    parser.add_argument("-s", "--socket", default=None, type=str,
+                        help="Unix socket path to listen on")
+    parser.add_argument("-p", "--port", default=None, type=int,
+                        help="Localhost TCP port to listen on")
+    parser.add_argument("-j", "--workers", default=None, type=int,
+                        help="Worker processes, all cores by default")
+    parser.add_argument("--max-jobs", default=None, type=int,
+                        help="Jobs running at once, the rest wait")
+    parser.add_argument("--max-ticks", default=None, type=int,
+                        help="Tick budget cap of a job")
+    parser.add_argument("--max-instructions", default=None, type=int,
+                        help="Instruction budget cap of a job")
+    parser.add_argument("--max-wall-time", default=None, type=float,
+                        help="Wall time cap of a job in seconds")
+    args = parser.parse_args()
+    if (args.socket is None) == (args.port is None):
+        parser.error('exactly one of --socket and --port is required')
+    with JobService(args.workers, args.max_jobs, args.max_ticks,
+                    args.max_instructions, args.max_wall_time) as service:
+        asyncio.run(service.serve(args.socket, args.port))
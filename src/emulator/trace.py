@@ -0,0 +1,322 @@
+import argparse
+import queue
+import struct
+import threading
+import zlib
+from enum import Enum
+
+TRACE_BUFFER_SIZE = 1 << 20
+
+
+class TraceLevel(Enum):
+    OFF = 'off'
+    INSTRUCTION = 'instruction'
+    # Data path steps of the microcode engine followed by the instruction
+    # state, other engines trace whole instructions
+    MICRO_STEP = 'micro'
+    HALT = 'halt'
+    # Last states before halt, an exception or a trigger
+    FLIGHT = 'flight'
+
+
+class TraceFormat(Enum):
+    TEXT = 'text'
+    BINARY = 'binary'
+
+
+# What the emulation loop does when the trace queue is full
+class OverflowPolicy(Enum):
+    BLOCK = 'block'
+    DROP = 'drop'
+
+
+# State is (tick, instruction, PC, SP, CR, AR, DR, SR, BR, TOS, NOS) with
+# every value already masked to its register width
+def format_state(state):
+    tick, instruction, pc, sp, cr, ar, dr, sr, br, tos, nos = state
+    return (
+        f'Tick: {tick} \t'
+        f'| Instruction: {instruction}   '
+        f'| PC: {pc:06X} '
+        f'| SP: {sp:06X} '
+        f'| CR: {cr:08X} '
+        f'| AR: {ar:06X} '
+        f'| DR: {dr:08X} '
+        f'| SR: {sr:04X} '
+        f'| BR: {br:08X} '
+        f'| TOS: {tos:08X} '
+        f'| NOS: {nos:08X}'
+    )
+
+
+# Trace file with a large write buffer, does nothing without a path
+class TraceWriter:
+    def __init__(self, path, buffer_size=TRACE_BUFFER_SIZE):
+        self.file = None
+        if path is not None:
+            self.file = open(path, 'w', buffering=buffer_size)
+
+    def write(self, line):
+        self.file.write(line + '\n')
+
+    def record(self, state):
+        self.file.write(format_state(state) + '\n')
+
+    # Separates trace windows
+    def mark(self, reason):
+        self.file.write(f'--- {reason} ---\n')
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# Binary trace, records after the header form a single zlib stream:
+#   header    magic and version
+#   keyframe  mask with KEYFRAME set, tick and instruction as u64, then all
+#             nine register and stack values as u32
+#   delta     mask of changed values, tick delta as u16, instruction delta
+#             as u8, then only the changed values as u32
+TRACE_MAGIC = b'CSAT'
+TRACE_VERSION = 1
+KEYFRAME = 0x8000
+STATE_VALUES = 9
+ALL_VALUES = (1 << STATE_VALUES) - 1
+KEYFRAME_INTERVAL = 1024
+COMPRESSION_LEVEL = 1
+
+trace_header = struct.Struct('<4sHH')
+keyframe_record = struct.Struct('<HQQ' + 'I' * STATE_VALUES)
+mask_field = struct.Struct('<H')
+delta_header = struct.Struct('<HB')
+# Delta record layout for every mask
+delta_records = [struct.Struct('<HHB' + 'I' * bin(mask).count('1'))
+                 for mask in range(ALL_VALUES + 1)]
+delta_values = [struct.Struct('<' + 'I' * bin(mask).count('1'))
+                for mask in range(ALL_VALUES + 1)]
+
+
+class BinaryTraceWriter(TraceWriter):
+    def __init__(self, path, buffer_size=TRACE_BUFFER_SIZE,
+                 keyframe_interval=KEYFRAME_INTERVAL):
+        self.file = None
+        if path is not None:
+            self.file = open(path, 'wb', buffering=buffer_size)
+            self.file.write(trace_header.pack(TRACE_MAGIC, TRACE_VERSION, 0))
+        self.keyframe_interval = keyframe_interval
+        self.countdown = 0
+        self.previous = None
+        self.compressor = zlib.compressobj(COMPRESSION_LEVEL)
+        # Records are compressed a keyframe interval at a time
+        self.records = []
+
+    def write(self, line):
+        raise ValueError('Binary trace stores instruction states only')
+
+    # Windows follow each other, a gap in ticks starts a new keyframe
+    def mark(self, reason):
+        pass
+
+    def record(self, state):
+        previous = self.previous
+        self.previous = state
+        self.countdown -= 1
+        if self.countdown >= 0:
+            tick_delta = state[0] - previous[0]
+            instruction_delta = state[1] - previous[1]
+            if 0 <= tick_delta <= 0xFFFF and 0 <= instruction_delta <= 0xFF:
+                mask = 0
+                changed = []
+                for i in range(STATE_VALUES):
+                    if state[i + 2] != previous[i + 2]:
+                        mask |= 1 << i
+                        changed.append(state[i + 2])
+                self.records.append(delta_records[mask].pack(
+                    mask, tick_delta, instruction_delta, *changed))
+                return
+
+        self.flush()
+        self.countdown = self.keyframe_interval - 1
+        self.records.append(
+            keyframe_record.pack(KEYFRAME | ALL_VALUES, *state))
+
+    def flush(self):
+        if self.records:
+            self.file.write(self.compressor.compress(b''.join(self.records)))
+            self.records = []
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            self.file.write(self.compressor.flush())
+        super().close()
+
+
+trace_writers = {
+    TraceFormat.TEXT: TraceWriter,
+    TraceFormat.BINARY: BinaryTraceWriter
+}
+
+TRACE_BATCH_SIZE = 256
+
+
+class TraceMark:
+    def __init__(self, reason):
+        self.reason = reason
+
+
+# Hands states and lines over to a writer thread in batches, the queue holds
+# at most capacity entries. Dropped entries are counted, everything queued
+# is written out on close. An error of the writer is kept by the thread,
+# which goes on draining the queue, and raised on the emulation thread
+class AsyncTraceWriter:
+    def __init__(self, writer, capacity, overflow=OverflowPolicy.BLOCK):
+        self.writer = writer
+        self.overflow = overflow
+        self.batch = []
+        self.dropped = 0
+        self.error = None
+        self.queue = queue.Queue(max(1, capacity // TRACE_BATCH_SIZE))
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def drain(self):
+        record = self.writer.record
+        write = self.writer.write
+        mark = self.writer.mark
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                for entry in batch:
+                    if isinstance(entry, tuple):
+                        record(entry)
+                    elif isinstance(entry, str):
+                        write(entry)
+                    else:
+                        mark(entry.reason)
+            except Exception as error:
+                self.error = error
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def put(self, batch):
+        if self.overflow == OverflowPolicy.BLOCK:
+            self.queue.put(batch)
+            return
+        try:
+            self.queue.put_nowait(batch)
+        except queue.Full:
+            self.dropped += len(batch)
+
+    def submit(self):
+        self.check()
+        batch = self.batch
+        self.batch = []
+        self.put(batch)
+
+    def record(self, state):
+        self.batch.append(state)
+        if len(self.batch) >= TRACE_BATCH_SIZE:
+            self.submit()
+
+    def write(self, line):
+        self.batch.append(line)
+        if len(self.batch) >= TRACE_BATCH_SIZE:
+            self.submit()
+
+    def mark(self, reason):
+        self.batch.append(TraceMark(reason))
+        if len(self.batch) >= TRACE_BATCH_SIZE:
+            self.submit()
+
+    def close(self):
+        if self.thread is None:
+            return
+        if self.batch:
+            self.put(self.batch)
+            self.batch = []
+        # The thread drains until the end even after an error
+        self.queue.put(None)
+        self.thread.join()
+        self.thread = None
+        self.writer.close()
+        if self.dropped:
+            print(f'Trace queue overflowed, {self.dropped} entries dropped')
+        self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_trace(path, trace_format=TraceFormat.TEXT, queue_size=0,
+               overflow=OverflowPolicy.BLOCK):
+    writer = trace_writers[trace_format](path)
+    if path is None or queue_size <= 0:
+        return writer
+    return AsyncTraceWriter(writer, queue_size, overflow)
+
+
+def read_binary_trace(data):
+    magic, version, _ = trace_header.unpack_from(data)
+    if magic != TRACE_MAGIC:
+        raise ValueError('Invalid trace magic')
+    if version != TRACE_VERSION:
+        raise ValueError(f'Unsupported trace version: {version}')
+
+    data = zlib.decompress(data[trace_header.size:])
+    offset = 0
+    state = None
+    while offset < len(data):
+        mask, = mask_field.unpack_from(data, offset)
+        if mask & KEYFRAME:
+            state = list(keyframe_record.unpack_from(data, offset)[1:])
+            offset += keyframe_record.size
+        else:
+            if state is None:
+                raise ValueError('Trace does not start with a keyframe')
+            tick_delta, instruction_delta = delta_header.unpack_from(
+                data, offset + mask_field.size)
+            state[0] += tick_delta
+            state[1] += instruction_delta
+            offset += mask_field.size + delta_header.size
+            values = iter(delta_values[mask].unpack_from(data, offset))
+            offset += delta_values[mask].size
+            for i in range(STATE_VALUES):
+                if mask & 1 << i:
+                    state[i + 2] = next(values)
+        yield tuple(state)
+
+
+# Renders a binary trace into the text trace
+def render_trace(source, output):
+    with open(source, 'rb') as file:
+        data = file.read()
+    with open(output, 'w', buffering=TRACE_BUFFER_SIZE) as file:
+        for state in read_binary_trace(data):
+            file.write(format_state(state) + '\n')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CSA Lab 3 trace renderer")
+    parser.add_argument("-s", "--source", required=True, type=str,
+                        help="File with binary trace")
+    parser.add_argument("-o", "--output", required=True, type=str,
+                        help="File with text trace")
+    args = parser.parse_args()
+    render_trace(args.source, args.output)
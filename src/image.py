@@ -0,0 +1,82 @@
+import struct
+import sys
+from array import array
+
+# Binary program image:
+#   header   magic, version, flags, entry point, segment and symbol counts
+#   segments (start, length) followed by length little-endian 32-bit words
+#   symbols  (address, name length) followed by the UTF-8 name
+IMAGE_MAGIC = b'CSAI'
+IMAGE_VERSION = 1
+HAS_ENTRY = 0x1
+
+header = struct.Struct('<4sHHIII')
+segment_header = struct.Struct('<II')
+symbol_header = struct.Struct('<IH')
+
+
+def is_image(data):
+    return data[:len(IMAGE_MAGIC)] == IMAGE_MAGIC
+
+
+# Groups cells into runs of consecutive addresses
+def split_segments(machine_code):
+    segments = []
+    for addr in sorted(machine_code):
+        if segments and segments[-1][0] + len(segments[-1][1]) == addr:
+            segments[-1][1].append(machine_code[addr])
+        else:
+            segments.append((addr, [machine_code[addr]]))
+    return segments
+
+
+def pack_image(machine_code, entry=None, symbols=None):
+    symbols = symbols or {}
+    segments = split_segments(machine_code)
+    chunks = [header.pack(IMAGE_MAGIC, IMAGE_VERSION,
+                          HAS_ENTRY if entry is not None else 0,
+                          entry or 0, len(segments), len(symbols))]
+    for start, values in segments:
+        words = array('I', values)
+        if sys.byteorder == 'big':
+            words.byteswap()
+        chunks.append(segment_header.pack(start, len(words)))
+        chunks.append(words.tobytes())
+    for name, addr in symbols.items():
+        encoded = name.encode('utf-8')
+        chunks.append(symbol_header.pack(addr, len(encoded)))
+        chunks.append(encoded)
+    return b''.join(chunks)
+
+
+# Returns the entry point (or None), segments as (start, words) with words
+# viewing the image without copying, and the symbol table
+def unpack_image(data):
+    data = memoryview(data)
+    magic, version, flags, entry, segment_count, symbol_count = \
+        header.unpack_from(data)
+    if magic != IMAGE_MAGIC:
+        raise ValueError('Invalid image magic')
+    if version != IMAGE_VERSION:
+        raise ValueError(f'Unsupported image version: {version}')
+
+    offset = header.size
+    segments = []
+    for _ in range(segment_count):
+        start, length = segment_header.unpack_from(data, offset)
+        offset += segment_header.size
+        words = data[offset:offset + length * 4]
+        if sys.byteorder == 'big':
+            words = array('I', words)
+            words.byteswap()
+        segments.append((start, memoryview(words).cast('I')))
+        offset += length * 4
+
+    symbols = {}
+    for _ in range(symbol_count):
+        addr, length = symbol_header.unpack_from(data, offset)
+        offset += symbol_header.size
+        symbols[bytes(data[offset:offset + length]).decode('utf-8')] = addr
+        offset += length
+
+    return entry if flags & HAS_ENTRY else None, segments, symbols
@@ -1,3 +1,4 @@
+from src.image import pack_image
 from src.translator.syntax_analyzer import SectionNode, LabelNode, \
     InstructionNode
 
@@ -28,14 +29,9 @@ class MachineCodeGenerator:
         self.serialized_code = ""
         self.devices_section_present = False
 
-    def check_address_for_label(self, address):
-        res = ""
-        for label, addr in self.label_addresses.items():
-            if addr == address:
-                if res != "":
-                    res += ", "
-                res = label
-        return " <- " + res if res != "" else ""
+    # Only the last label of an address is printed
+    def address_labels(self):
+        return {addr: label for label, addr in self.label_addresses.items()}
 
     def generate(self):
         data_section_indices = []
@@ -72,14 +68,21 @@ class MachineCodeGenerator:
             self.generate_devices_section(devices_section_index)
 
         entry_addr = self.label_addresses.get('start')
+        labels = self.address_labels()
         self.serialized_code = "".join(
             f"{k:06x} {'>' if k == entry_addr else ':'} {v:08x} "
-            f"{self.check_address_for_label(k)} \n"
+            f"{' <- ' + labels[k] if k in labels else ''} \n"
             for k, v in
             sorted(self.machine_code.items()))
 
         return self.serialized_code
 
+    # Binary image of the generated code, call after generate()
+    def generate_image(self):
+        return pack_image(self.machine_code,
+                          self.label_addresses.get('start'),
+                          self.label_addresses)
+
     def generate_data_section(self, start_index):
         it = start_index + 1
         cell_pos = 0
@@ -11,7 +11,7 @@ token_specification = [
     ('SECTION', r'.section\s+(text|data|devices)'),  # Section
     ('COMMENT', r';[^\n]*'),  # Comment
     ('OPCODE',
-     r'(?i)(pushf|popf|push|str|pop|inc|dec|swap|dup|nop|jmp|call|ret|halt'
+     r'(pushf|popf|push|str|pop|inc|dec|swap|dup|nop|jmp|call|ret|halt'
      r'|int|iret|ei|di|in|out|add|sub|mul|div|and|or|xor|not|neg|ld|st|cmp|jz'
      r'|je|jnz|jg|jge|jl|jle|res|byte|char|shl|shr|rol|ror|addr|set|unset'
      r'|check)[^a-zA-Z0-9_]'),  # Opcode
@@ -22,9 +22,9 @@ token_specification = [
     ('MISMATCH', r'.'),  # Any other character
 ]
 
-# Compile the regular expressions
+# Compile the regular expressions, matching is case-insensitive
 token_re = '|'.join('(?P<%s>%s)' % pair for pair in token_specification)
-get_token = re.compile(token_re).match
+get_token = re.compile(token_re, re.IGNORECASE).match
 
 
 def process_value(kind, value):
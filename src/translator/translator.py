@@ -5,21 +5,33 @@ import src.translator.semantic_analyzer as semparser
 import src.translator.generator as generator
 
 
-def main(source, output):
-    with open(source, 'r', encoding='utf-8') as file:
-        assembly_file = file.read()
-
-    tokens = list(lexer.lex(assembly_file))
+# Translates assembly text, returns the generator holding the machine code
+def translate(assembly):
+    tokens = list(lexer.lex(assembly))
     syntax_parser = astparser.SyntaxAnalyzer(tokens)
     syntax_tree = syntax_parser.parse()
     semantic_analyzer = semparser.SemanticAnalyzer(syntax_tree)
     semantic_analyzer.analyze()
 
     gen = generator.MachineCodeGenerator(syntax_tree)
-    machine_code = gen.generate()
+    gen.generate()
+    return gen
+
+
+def main(source, output):
+    with open(source, 'r', encoding='utf-8') as file:
+        assembly_file = file.read()
+
+    gen = translate(assembly_file)
+    machine_code = gen.serialized_code
 
-    with open(output, 'w', encoding='utf-8') as output_file:
-        output_file.write(machine_code)
+    # Binary image for .bin outputs, text operation codes otherwise
+    if output.endswith('.bin'):
+        with open(output, 'wb') as output_file:
+            output_file.write(gen.generate_image())
+    else:
+        with open(output, 'w', encoding='utf-8') as output_file:
+            output_file.write(machine_code)
 
     print(f'File successfully saved to {output}')
 
@@ -30,6 +42,7 @@ if __name__ == "__main__":
     parser.add_argument("-s", "--source", required=True, type=str,
                         help="File with asm code")
     parser.add_argument("-o", "--output", required=True, type=str,
-                        help="File with output sources")
+                        help="File with output sources, .bin for a binary "
+                             "image")
     args = parser.parse_args()
     main(args.source, args.output)
@@ -1,6 +1,25 @@
+import asyncio
+import base64
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
 import pytest
 
-from src.emulator.emulator import main as emulator_main
+from src.emulator import pacer
+from src.emulator.batch import main as batch_main, run_batch
+from src.emulator.components.memory import Memory, PagedMemory
+from src.emulator.components.registers import Registry
+from src.emulator.components.sink import ListSink
+from src.emulator.emulator import Emulator, main as emulator_main
+from src.emulator.fork_server import submit
+from src.emulator.service import JobService
+from src.emulator.trace import AsyncTraceWriter, OverflowPolicy, \
+    TRACE_BATCH_SIZE, TraceFormat, TraceLevel, render_trace
+from src.translator.translator import main as translator_main, translate
 
 
 @pytest.mark.timeout(5)
@@ -60,6 +79,27 @@ def test_cat():
     assert output == output_expected and io == io_expected
 
 
+@pytest.mark.timeout(5)
+def test_cat_interrupt(tmp_path):
+    emulator_main('test/sources/cat_interrupt.opc',
+                  ['Hello, World!', 'I', 'love', 'CSA', 'Lab3'],
+                  trace_path=str(tmp_path / 'sources.txt'),
+                  io_path=str(tmp_path / 'out.txt'))
+    with open(tmp_path / 'sources.txt', 'r') as golden_file:
+        output = golden_file.read()
+
+    with open(tmp_path / 'out.txt', 'r') as golden_file:
+        io = golden_file.read()
+
+    with open('test/output/cat_interrupt.txt', 'r') as test_file:
+        output_expected = test_file.read()
+
+    with open('test/io/cat_interrupt.txt', 'r') as test_file:
+        io_expected = test_file.read()
+
+    assert output == output_expected and io == io_expected
+
+
 @pytest.mark.timeout(5)
 def test_prob5():
     emulator_main('test/sources/prob5.opc')
@@ -76,3 +116,537 @@ def test_prob5():
         io_expected = test_file.read()
 
     assert output == output_expected and io == io_expected
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize('name, input_queue', [
+    ('hello_world', ['Hello, World!']),
+    ('hello_username', ['Amogus']),
+    ('cat', ['Hello, World!', 'I', 'love', 'CSA', 'Lab3']),
+    ('cat_interrupt', ['Hello, World!', 'I', 'love', 'CSA', 'Lab3']),
+    ('prob5', None),
+])
+def test_functional_engine(name, input_queue, tmp_path):
+    emulator_main(f'test/sources/{name}.opc', input_queue,
+                  engine='functional',
+                  trace_path=str(tmp_path / 'sources.txt'),
+                  io_path=str(tmp_path / 'out.txt'))
+    with open(tmp_path / 'sources.txt', 'r') as golden_file:
+        output = golden_file.read()
+
+    with open(tmp_path / 'out.txt', 'r') as golden_file:
+        io = golden_file.read()
+
+    with open(f'test/output/{name}.txt', 'r') as test_file:
+        output_expected = test_file.read()
+
+    with open(f'test/io/{name}.txt', 'r') as test_file:
+        io_expected = test_file.read()
+
+    assert output == output_expected and io == io_expected
+
+
+# The block engine steps single instructions for the trace
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize('name, input_queue', [
+    ('hello_world', ['Hello, World!']),
+    ('hello_username', ['Amogus']),
+    ('cat', ['Hello, World!', 'I', 'love', 'CSA', 'Lab3']),
+    ('cat_interrupt', ['Hello, World!', 'I', 'love', 'CSA', 'Lab3']),
+    ('cat_interrupt_delayed', ['Hello, World!', 'I', 'love', 'CSA', 'Lab3']),
+    ('prob5', None),
+])
+def test_block_engine(name, input_queue, tmp_path):
+    emulator_main(f'test/sources/{name}.opc', input_queue, engine='block',
+                  trace_path=str(tmp_path / 'sources.txt'),
+                  io_path=str(tmp_path / 'out.txt'))
+    with open(tmp_path / 'sources.txt', 'r') as golden_file:
+        output = golden_file.read()
+
+    with open(tmp_path / 'out.txt', 'r') as golden_file:
+        io = golden_file.read()
+
+    with open(f'test/output/{name}.txt', 'r') as test_file:
+        output_expected = test_file.read()
+
+    with open(f'test/io/{name}.txt', 'r') as test_file:
+        io_expected = test_file.read()
+
+    assert output == output_expected and io == io_expected
+
+
+# Stack pushed over the device cells wakes the devices on every engine
+@pytest.mark.timeout(10)
+def test_stack_over_devices():
+    program = translate('.section text\nstart:\n    push 1\n    ror\n'
+                        '    dup\n    swap\n    cmp\n    pushf\n'
+                        '    call routine\n    halt\nroutine:\n    ret\n')
+    transcripts = []
+    for sp in range(24):
+        results = []
+        for engine in ('microcode', 'functional', 'block'):
+            emulator = Emulator(program, engine=engine)
+            emulator.registry.SP = sp
+            result = emulator.run()
+            results.append((result.tick, result.instruction,
+                            result.registers, result.io))
+
+        assert results[0] == results[1] == results[2]
+        transcripts += results[0][3]
+
+    assert transcripts
+
+
+@pytest.mark.timeout(5)
+def test_paged_memory(tmp_path):
+    emulator_main('test/sources/prob5.opc', memory_model='paged',
+                  trace_path=str(tmp_path / 'sources.txt'),
+                  io_path=str(tmp_path / 'out.txt'))
+    with open(tmp_path / 'sources.txt', 'r') as golden_file:
+        output = golden_file.read()
+
+    with open(tmp_path / 'out.txt', 'r') as golden_file:
+        io = golden_file.read()
+
+    with open('test/output/prob5.txt', 'r') as test_file:
+        output_expected = test_file.read()
+
+    with open('test/io/prob5.txt', 'r') as test_file:
+        io_expected = test_file.read()
+
+    assert output == output_expected and io == io_expected
+
+
+def test_paged_memory_fork():
+    memory = PagedMemory(Registry())
+    memory.cells[0x10] = 1
+    fork = memory.fork(Registry())
+    fork.cells[0x10] = 2
+    memory.cells[0xFFFFFF] = 3
+
+    assert memory.cells[0x10] == 1 and fork.cells[0x10] == 2
+    assert fork.cells[0xFFFFFF] == 0
+
+
+@pytest.mark.timeout(5)
+def test_binary_image(tmp_path):
+    translator_main('asm/prob5.asm', str(tmp_path / 'prob5.bin'))
+    emulator_main(str(tmp_path / 'prob5.bin'),
+                  trace_path=str(tmp_path / 'sources.txt'),
+                  io_path=str(tmp_path / 'out.txt'))
+    with open(tmp_path / 'sources.txt', 'r') as golden_file:
+        output = golden_file.read()
+
+    with open(tmp_path / 'out.txt', 'r') as golden_file:
+        io = golden_file.read()
+
+    with open('test/output/prob5.txt', 'r') as test_file:
+        output_expected = test_file.read()
+
+    with open('test/io/prob5.txt', 'r') as test_file:
+        io_expected = test_file.read()
+
+    assert output == output_expected and io == io_expected
+
+
+@pytest.mark.timeout(5)
+def test_binary_trace(tmp_path):
+    emulator_main('test/sources/hello_username.opc', ['Amogus'],
+                  trace_path=str(tmp_path / 'trace.bin'),
+                  trace_format=TraceFormat.BINARY,
+                  io_path=str(tmp_path / 'out.txt'))
+    render_trace(str(tmp_path / 'trace.bin'), str(tmp_path / 'trace.txt'))
+    with open(tmp_path / 'trace.txt', 'r') as golden_file:
+        output = golden_file.read()
+
+    with open('test/output/hello_username.txt', 'r') as test_file:
+        output_expected = test_file.read()
+
+    assert output == output_expected
+
+
+@pytest.mark.timeout(5)
+def test_async_trace(tmp_path):
+    emulator_main('test/sources/prob5.opc', trace_queue=1024,
+                  trace_path=str(tmp_path / 'sources.txt'),
+                  io_path=str(tmp_path / 'out.txt'))
+    with open(tmp_path / 'sources.txt', 'r') as golden_file:
+        output = golden_file.read()
+
+    with open('test/output/prob5.txt', 'r') as test_file:
+        output_expected = test_file.read()
+
+    assert output == output_expected
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize('trace_level, golden', [
+    (TraceLevel.OFF, None),
+    (TraceLevel.HALT, 'test/output/hello_world_halt.txt'),
+    (TraceLevel.INSTRUCTION, 'test/output/hello_world.txt'),
+    (TraceLevel.MICRO_STEP, 'test/output/hello_world_micro.txt'),
+])
+def test_trace_levels(trace_level, golden, tmp_path):
+    trace_path = tmp_path / 'trace.txt'
+    emulator_main('test/sources/hello_world.opc', ['Hello, World!'],
+                  trace_level=trace_level, trace_path=str(trace_path),
+                  io_path=str(tmp_path / 'out.txt'))
+
+    if golden is None:
+        assert not trace_path.exists()
+    else:
+        with open(golden, 'r') as test_file:
+            output_expected = test_file.read()
+        assert trace_path.read_text() == output_expected
+
+
+def test_micro_step_binary_trace(tmp_path):
+    with pytest.raises(ValueError):
+        emulator_main('test/sources/hello_world.opc', ['Hello, World!'],
+                      trace_level=TraceLevel.MICRO_STEP,
+                      trace_path=str(tmp_path / 'trace.bin'),
+                      trace_format=TraceFormat.BINARY,
+                      io_path=str(tmp_path / 'out.txt'))
+
+
+# Writer that holds the first state until released
+class StalledWriter:
+    def __init__(self):
+        self.states = []
+        self.stalled = threading.Event()
+        self.released = threading.Event()
+
+    def record(self, state):
+        self.stalled.set()
+        self.released.wait()
+        self.states.append(state)
+
+    def write(self, line):
+        pass
+
+    def mark(self, reason):
+        pass
+
+    def close(self):
+        pass
+
+
+@pytest.mark.timeout(5)
+def test_trace_overflow_drop():
+    writer = StalledWriter()
+    trace = AsyncTraceWriter(writer, TRACE_BATCH_SIZE, OverflowPolicy.DROP)
+    for state in range(TRACE_BATCH_SIZE):
+        trace.record((state,))
+    writer.stalled.wait()
+    # One batch fits into the queue, the next ones are dropped
+    for state in range(TRACE_BATCH_SIZE, 4 * TRACE_BATCH_SIZE):
+        trace.record((state,))
+    writer.released.set()
+    trace.close()
+
+    assert trace.dropped == 2 * TRACE_BATCH_SIZE
+    assert writer.states == [(state,) for state
+                             in range(2 * TRACE_BATCH_SIZE)]
+
+
+# Writer of a full disk
+class FailingWriter(StalledWriter):
+    def record(self, state):
+        raise OSError('No space left on device')
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize('overflow', list(OverflowPolicy))
+def test_trace_writer_error(overflow):
+    trace = AsyncTraceWriter(FailingWriter(), TRACE_BATCH_SIZE, overflow)
+    with pytest.raises(OSError):
+        with trace:
+            for state in range(8 * TRACE_BATCH_SIZE):
+                trace.record((state,))
+
+    assert trace.thread is None
+
+
+@pytest.mark.timeout(5)
+def test_flight_recorder(tmp_path):
+    emulator_main('test/sources/prob5.opc', trace_level=TraceLevel.FLIGHT,
+                  trace_window=16, trace_path=str(tmp_path / 'sources.txt'),
+                  io_path=str(tmp_path / 'out.txt'))
+    with open(tmp_path / 'sources.txt', 'r') as golden_file:
+        output = golden_file.read()
+
+    with open('test/output/prob5.txt', 'r') as test_file:
+        output_expected = test_file.read()
+
+    assert output.splitlines() == (['--- halt ---']
+                                   + output_expected.splitlines()[-16:])
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize('engine', ['microcode', 'functional', 'block'])
+def test_cell_trigger(engine, tmp_path):
+    emulator = Emulator('test/sources/cat.opc', ['Hello'], engine=engine)
+    emulator.run(trace_level=TraceLevel.FLIGHT,
+                 trace_path=str(tmp_path / 'trace.txt'), trace_window=2,
+                 trace_triggers=['cell:buffer_0'])
+
+    assert (tmp_path / 'trace.txt').read_text().splitlines()[0] == \
+        '--- cell 000020 written ---'
+    assert not emulator.memory.watched(0x20)
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize('engine', ['microcode', 'functional', 'block'])
+def test_fast_forward(engine, tmp_path):
+    states = []
+    results = []
+    for fast_forward in (False, True):
+        trace_path = tmp_path / f'{fast_forward}.txt'
+        results.append(Emulator('test/sources/cat_interrupt.opc',
+                                [(50000, 'Hello, World!')], engine=engine)
+                       .run(TraceLevel.HALT, str(trace_path),
+                            fast_forward=fast_forward))
+        states.append(trace_path.read_text())
+
+    assert states[0] == states[1] and 'Tick: 50125' in states[1]
+    assert results[0].skipped_ticks == 0
+    assert results[1].skipped_ticks > 40000
+
+
+@pytest.mark.timeout(5)
+def test_device_sinks(tmp_path):
+    sink = ListSink()
+    emulator_main('test/sources/cat.opc', ['Hello', 'CSA'],
+                  trace_level=TraceLevel.OFF, sinks={1: sink},
+                  io_path=str(tmp_path / 'out.txt'))
+    with open(tmp_path / 'out.txt', 'r') as golden_file:
+        io = golden_file.read()
+
+    assert sink.lines == ['> Hello', '> CSA'] and io == '< Hello\n< CSA\n'
+
+
+@pytest.mark.timeout(5)
+def test_input_file(tmp_path):
+    source = tmp_path / 'input.txt'
+    source.write_text('Hello\nCSA')
+    emulator_main('test/sources/cat.opc', input_path=str(source),
+                  trace_level=TraceLevel.OFF,
+                  io_path=str(tmp_path / 'out.txt'))
+    with open(tmp_path / 'out.txt', 'r') as golden_file:
+        lines = golden_file.read()
+
+    emulator_main('test/sources/cat.opc', input_path=str(source),
+                  input_chunk=4, trace_level=TraceLevel.OFF,
+                  io_path=str(tmp_path / 'out.txt'))
+    with open(tmp_path / 'out.txt', 'r') as golden_file:
+        chunks = golden_file.read()
+
+    assert lines == '< Hello\n> Hello\n< CSA\n> CSA\n'
+    assert chunks == '< Hell\n> Hell\n< o\nCS\n> o\nCS\n< A\n> A\n'
+
+
+def test_buffer_bytes():
+    memory = Memory(Registry())
+    memory.cells[0x21] = 0x11223344
+    memory.write_bytes(0x20, b'ABCDE')
+
+    assert memory.cells[0x20] == 0x41424344
+    assert memory.cells[0x21] == 0x45223344
+    assert memory.read_bytes(0x20, 5) == b'ABCDE'
+
+
+@pytest.mark.timeout(5)
+def test_emulator_api(tmp_path, monkeypatch):
+    with open('test/sources/cat.opc', 'rb') as file:
+        program = file.read()
+    monkeypatch.chdir(tmp_path)
+    result = Emulator(program, ['Hello'], engine='functional').run()
+
+    assert result.status == 'halted' and result.io == ['< Hello', '> Hello']
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.timeout(5)
+def test_tick_limit():
+    result = Emulator('test/sources/cat_interrupt.opc',
+                      max_ticks=10000).run()
+
+    assert result.status == 'limit' and 10000 <= result.tick < 10100
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.sleeps.append(delay)
+        self.now += delay
+
+
+@pytest.mark.parametrize('frequency', [1000, 4000])
+def test_pacer(frequency, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(pacer, 'time', clock)
+    emulated = pacer.Pacer(frequency)
+    next_tick = emulated.start(0)
+    while next_tick < 2000:
+        next_tick = emulated.pace(next_tick)
+
+    assert sum(clock.sleeps) == pytest.approx(
+        (next_tick - emulated.batch_ticks) / frequency)
+    assert pacer.Pacer().pace(2000) == float('inf')
+    for invalid in (0, -1):
+        with pytest.raises(ValueError):
+            pacer.Pacer(invalid)
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize('engine', ['microcode', 'functional', 'block'])
+def test_exact_limits(engine):
+    runaway = translate('.section text\nstart:\n    push 1\n    jmp start\n')
+    result = Emulator(runaway, engine=engine, max_instructions=1000).run()
+
+    assert result.limit == 'instruction' and result.instruction == 1000
+
+    result = Emulator(runaway, engine=engine, max_ticks=1000).run()
+
+    assert result.limit == 'tick' and result.tick == 1003
+
+
+@pytest.mark.timeout(5)
+@pytest.mark.parametrize('engine', ['microcode', 'functional', 'block'])
+def test_watchdog_limits(engine):
+    runaway = '.section text\nstart:\n    push 1\n    jmp start\n'
+    result = Emulator(translate(runaway), engine=engine,
+                      max_stack_depth=1000).run()
+
+    # Stopped at the first push past the limit
+    assert result.status == 'limit' and result.limit == 'stack depth'
+    assert result.registers['SP'] == 0x1000000 - 1001
+    assert result.pc == 0x30
+    assert f'at PC {result.pc:06X}' in result.error
+
+    result = Emulator('test/sources/cat_interrupt.opc', engine=engine,
+                      max_wall_time=0.1).run()
+
+    assert result.status == 'limit' and result.limit == 'wall time'
+    assert result.instruction > 0
+
+
+@pytest.mark.timeout(10)
+def test_batch_runner(tmp_path):
+    manifest = tmp_path / 'manifest.jsonl'
+    manifest.write_text(
+        json.dumps({'id': 'cat', 'program': 'test/sources/cat.opc',
+                    'input': ['Hello']}) + '\n'
+        + json.dumps({'id': 'loop',
+                      'program': 'test/sources/cat_interrupt.opc',
+                      'engine': 'functional', 'max_ticks': 1000}) + '\n')
+    batch_main(str(manifest), str(tmp_path / 'out'),
+               str(tmp_path / 'results.jsonl'), 2)
+    with open(tmp_path / 'results.jsonl', 'r') as results_file:
+        results = {result['id']: result for result
+                   in map(json.loads, results_file)}
+
+    assert results['cat']['status'] == 'halted'
+    assert results['loop']['status'] == 'limit'
+    assert (tmp_path / 'out' / 'cat' / 'out.txt').read_text() == \
+        '< Hello\n> Hello\n'
+
+
+@pytest.mark.parametrize('ids', [
+    ['../escape'], ['/tmp/escape'], ['nested/job'], ['..'], ['same', 'same'],
+    [1, '1']
+])
+def test_batch_job_ids(ids, tmp_path):
+    jobs = [{'id': job_id, 'program': 'test/sources/cat.opc'}
+            for job_id in ids]
+    with pytest.raises(ValueError):
+        list(run_batch(jobs, str(tmp_path)))
+
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.timeout(10)
+def test_fork_server(tmp_path):
+    path = str(tmp_path / 'emulator.sock')
+    server = subprocess.Popen([sys.executable, '-m',
+                               'src.emulator.fork_server', '-s', path])
+    try:
+        while not os.path.exists(path):
+            time.sleep(0.01)
+        results = [submit(path, {'program': 'test/sources/cat.opc',
+                                 'input': [text]})
+                   for text in ('Hello', 'CSA')]
+    finally:
+        server.terminate()
+        server.wait()
+
+    assert [result['io'] for result in results] == [
+        ['< Hello', '> Hello'], ['< CSA', '> CSA']]
+
+
+async def request_job(path, job, cancel=False):
+    reader, writer = await asyncio.open_unix_connection(path)
+    writer.write(json.dumps(job).encode('utf-8') + b'\n')
+    if cancel:
+        writer.write(b'{"op": "cancel"}\n')
+    await writer.drain()
+    events = [json.loads(line) async for line in reader]
+    writer.close()
+    return events
+
+
+@pytest.mark.timeout(20)
+def test_job_service(tmp_path):
+    path = str(tmp_path / 'service.sock')
+    with open('asm/cat.asm', 'r') as source_file:
+        assembly = source_file.read()
+    with open('test/sources/cat_interrupt.opc', 'rb') as program_file:
+        idle_image = base64.b64encode(program_file.read()).decode('ascii')
+
+    async def scenario():
+        with JobService(workers=2) as service:
+            server = asyncio.create_task(service.serve(path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            events = await asyncio.gather(
+                request_job(path, {'assembly': assembly,
+                                   'input': ['Hello']}),
+                request_job(path, {'image': idle_image, 'input': []},
+                            cancel=True))
+            server.cancel()
+            return events
+
+    streamed, cancelled = asyncio.run(scenario())
+
+    assert [event.get('line') for event in streamed] == [
+        '< Hello', '> Hello', None]
+    assert streamed[-1]['status'] == 'halted'
+    assert cancelled[-1]['status'] == 'cancelled'
+
+
+@pytest.mark.timeout(10)
+def test_job_service_invalid_jobs(tmp_path):
+    path = str(tmp_path / 'service.sock')
+    with open('asm/cat.asm', 'r') as source_file:
+        assembly = source_file.read()
+
+    async def scenario():
+        with JobService(workers=1, max_ticks=1000) as service:
+            server = asyncio.create_task(service.serve(path))
+            while not os.path.exists(path):
+                await asyncio.sleep(0.01)
+            events = [await request_job(path, job) for job in (
+                [1], 'job', {'assembly': assembly, 'max_ticks': 'many'},
+                {'program': 'test/sources/cat.opc'},
+                {'assembly': assembly, 'input_path': 'asm/cat.asm'})]
+            server.cancel()
+            return events
+
+    for events in asyncio.run(scenario()):
+        assert len(events) == 1 and events[0]['status'] == 'error'